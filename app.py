@@ -1,14 +1,79 @@
-from fastapi import FastAPI, HTTPException, Form
-from pydantic import BaseModel, Field, validator
+from fastapi import FastAPI, HTTPException, Form, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError, validator
 from typing import Literal
-from fastapi.responses import JSONResponse
-import pickle
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 import numpy as np
+import orjson
+import json
+import logging
 import os
 
+from src.metrics import Metrics, SamplingProfiler
+from src.comparables import ComparablesIndex
+from src.compiled_model import CompiledLinearModel, CompiledTreeEnsemble
+from src.market_stats import BEDROOM_BUCKETS, UNKNOWN, MarketStatsCube
+from src.micro_batching import MicroBatcher
+from src.model_registry import ModelRegistry
+from src.prediction_cache import PredictionCache
+from src.reloading_file import ReloadingFile
+
 # Initialize FastAPI app
 app = FastAPI()
 
+logger = logging.getLogger(__name__)
+
+# Keep the segment models in memory instead of reading them from disk on every request.
+# MODEL_CACHE_SIZE bounds the number of models kept in memory (unset means all of them are preloaded).
+# MODEL_FORMAT=store serves the models from a memory-mapped model store shared by all the workers
+model_cache_size = os.environ.get('MODEL_CACHE_SIZE')
+models_dir = os.environ.get('MODELS_DIR', './models')
+model_format = os.environ.get('MODEL_FORMAT', 'compiled')
+model_registry = ModelRegistry(
+    models_dir=models_dir,
+    max_size=int(model_cache_size) if model_cache_size else None,
+    check_interval=float(os.environ.get('MODEL_RELOAD_INTERVAL', '5')),
+    prefer_compiled=model_format != 'pickle',
+    store_path=os.environ.get('MODEL_STORE_PATH', os.path.join(models_dir, 'model_store.bin')) if model_format == 'store' else None
+)
+
+# Reuse the predictions of repeated requests. PREDICTION_CACHE_SIZE enables the cache and bounds its number of
+# entries, and the features are rounded to PREDICTION_CACHE_DECIMALS decimals in the cache key
+prediction_cache_size = os.environ.get('PREDICTION_CACHE_SIZE')
+prediction_cache = PredictionCache(
+    max_size=int(prediction_cache_size),
+    ttl=float(os.environ['PREDICTION_CACHE_TTL']) if os.environ.get('PREDICTION_CACHE_TTL') else None,
+    decimals=int(os.environ.get('PREDICTION_CACHE_DECIMALS', '0'))
+) if prediction_cache_size else None
+
+# Drop the cached predictions of a segment whenever its model file changes or is removed
+if prediction_cache is not None:
+    model_registry.add_listener(prediction_cache.on_model_event)
+
+# Time every stage of the /predict requests and every model load, and count the requests per segment
+metrics = Metrics()
+model_registry.add_listener(metrics.on_model_event)
+
+# Market statistics cube served by /stats, built by python -m src.market_stats and reloaded when it changes
+stats_file = ReloadingFile(
+    os.environ.get('STATS_CUBE_PATH', os.path.join(models_dir, 'market_stats.npz')),
+    load=lambda path: MarketStatsCube.load(path)[0],
+    check_interval=model_registry.check_interval
+)
+
+# Index of the comparable listings served by /comparables, built by python -m src.comparables
+comparables_file = ReloadingFile(
+    os.environ.get('COMPARABLES_PATH', os.path.join(models_dir, 'comparables.npz')),
+    load=ComparablesIndex.load,
+    check_interval=model_registry.check_interval
+)
+
+# Maximum number of comparable listings returned per property
+max_comparables = 50
+
+# Sampling profiler that can be started and stopped at runtime, when PROFILER_ENABLED is set
+profiler = SamplingProfiler(interval=float(os.environ.get('PROFILER_INTERVAL_MS', '5')) / 1000)
+
 # Define the list of valid regions
 valid_regions = [
     "Brussels-Capital", 
@@ -24,6 +89,9 @@ valid_regions = [
     "East Flanders"
 ]
 
+# Define the feature names that are expected by the models, in the order the models expect them
+feature_names = ['number_of_bedrooms', 'living_area', 'terrace_area', 'surface_of_land', 'number_of_facades']
+
 # Define Pydantic model to validate the incoming request data
 class Data(BaseModel):
     type_of_property: Literal['house', 'apartment'] = Field(..., description="Type of property, must be either 'house' or 'apartment'.")
@@ -41,6 +109,19 @@ class Data(BaseModel):
             raise ValueError(f"Invalid region. Must be one of {', '.join(valid_regions)}.")
         return value
 
+# Load every model once when the API starts, unless the models are loaded lazily with an LRU bound,
+# and check the model files for changes in the background so requests never wait for the check
+@app.on_event("startup")
+def load_models():
+    if model_registry.max_size is None:
+        model_registry.load_all()
+    model_registry.start_refresher()
+
+# Stop checking the model files for changes when the API shuts down
+@app.on_event("shutdown")
+def stop_model_refresher():
+    model_registry.stop_refresher()
+
 # Define a root ("/") GET endpoint 
 @app.get("/")
 def read_root():
@@ -48,8 +129,32 @@ def read_root():
     return {"message": "Welcome to our real estate prediction API! You can make a POST request to /predict with the necessary property details to get a prediction."}
 
 # Define a predict ("/predict") POST endpoint 
+def predict_with_model(model, features):
+    """
+    Predicts the price of a batch of properties with the model they were looked up with.
+
+    Parameters:
+    model (object): The model of the segment of the properties, as returned by the model registry.
+    features (numpy.ndarray): The feature matrix, one row per property.
+
+    Returns:
+    numpy.ndarray: The predicted prices.
+    """
+    return model.predict(features)
+
+# Opt-in micro-batching of concurrent /predict requests: PREDICT_BATCH_WINDOW_MS is the maximum time
+# a request waits for other requests of the same segment, PREDICT_BATCH_MAX_ROWS the maximum batch size.
+# The requests are batched by the model the handler got from the registry, so the model is looked up once
+# per request, and requests that got a model before and after a reload are never scored together
+predict_batch_window_ms = os.environ.get('PREDICT_BATCH_WINDOW_MS')
+micro_batcher = MicroBatcher(
+    predict_with_model,
+    max_delay=float(predict_batch_window_ms) / 1000,
+    max_rows=int(os.environ.get('PREDICT_BATCH_MAX_ROWS', '64'))
+) if predict_batch_window_ms else None
+
 @app.post("/predict", status_code=201)
-def predict_price(
+async def predict_price(
     type_of_property: Literal['house', 'apartment'] = Form(...),
     number_of_bedrooms: float = Form(...),
     living_area: float = Form(...),
@@ -59,21 +164,31 @@ def predict_price(
     region: str = Form(...)
 ):
     # Create a data object from the form fields
-    property = Data(
-        type_of_property=type_of_property,
-        number_of_bedrooms=number_of_bedrooms,
-        living_area=living_area,
-        terrace_area=terrace_area,
-        surface_of_land=surface_of_land,
-        number_of_facades=number_of_facades,
-        region=region
-    )
-
-    # Define the model path
-    model_path = f'./models/{property.type_of_property}_{property.region}_model.pickle'
-
-    # Check if the model file exists
-    if not os.path.exists(model_path):
+    with metrics.time('validation'):
+        property = Data(
+            type_of_property=type_of_property,
+            number_of_bedrooms=number_of_bedrooms,
+            living_area=living_area,
+            terrace_area=terrace_area,
+            surface_of_land=surface_of_land,
+            number_of_facades=number_of_facades,
+            region=region
+        )
+    segment = (property.type_of_property, property.region)
+
+    # Read the generation of the model before getting it, so a prediction made while it is reloaded is not cached
+    generation = prediction_cache.generation(segment) if prediction_cache is not None else None
+
+    # Get the model from the registry. A model that is not loaded yet is read from disk in the thread pool,
+    # so loading it does not block the other requests
+    with metrics.time('model_lookup'):
+        model = model_registry.peek(*segment)
+        if model is None:
+            model = await run_in_threadpool(model_registry.get, *segment)
+
+    # Check if a model exists for this property type and region
+    if model is None:
+        metrics.count_request(segment, 404)
         return JSONResponse(
             status_code=404,
             content={
@@ -82,25 +197,43 @@ def predict_price(
         )
 
     try:
-        # Load the model using pickle
-        model = pickle.load(open(model_path, 'rb'))
+        # Extract features from the incoming request data
+        with metrics.time('feature_assembly'):
+            features = np.array([property.dict()[feat] for feat in feature_names])
 
-        # Define the feature names that are expected by the model
-        feature_names = ['number_of_bedrooms', 'living_area', 'terrace_area', 'surface_of_land', 'number_of_facades']
+        # Return the cached prediction of an identical (after rounding) request, if there is one
+        if prediction_cache is not None:
+            with metrics.time('cache_lookup'):
+                prediction = prediction_cache.get(segment, features)
+            if prediction is not None:
+                metrics.count_request(segment, 201)
+                return {"prediction price in euro": prediction}
 
-        # Extract features from the incoming request data
-        features = np.array([property.dict()[feat] for feat in feature_names])
+        with metrics.time('model_predict'):
+            if micro_batcher is not None:
+                # Score the features together with the concurrent requests for the same model
+                prediction = await micro_batcher.submit(model, features)
+            else:
+                # Reshape the features to match the input shape that the model expects
+                row = features.reshape(1, -1)
 
-        # Reshape the features to match the input shape that the model expects
-        features = features.reshape(1, -1)
+                # Make prediction using the model, outside of the event loop
+                prediction = (await run_in_threadpool(model.predict, row))[0]
 
-        # Make prediction using the model
-        prediction = model.predict(features)
+        prediction = float(prediction)
+        if prediction_cache is not None:
+            prediction_cache.put(segment, features, prediction, generation)
 
         # Return the prediction in the response
-        return {"prediction price in euro": float(prediction[0])}
+        metrics.count_request(segment, 201)
+        return {"prediction price in euro": prediction}
 
     except Exception as e:
+        # Log and count the failure, so that it does not go unnoticed behind the generic error response
+        logger.exception("Prediction failed for property type '%s' and region '%s'", *segment)
+        metrics.count_error(segment, e)
+        metrics.count_request(segment, 500)
+
         # If anything goes wrong during prediction, return a 500 error with the details of the exception
         return JSONResponse(
             status_code=500,
@@ -108,3 +241,367 @@ def predict_price(
                 "detail": f"An error occurred during prediction: {str(e)}. Please try again."
             }
         )
+
+# Segments accepted by the JSON predict endpoint, indexed once instead of scanning valid_regions on every request
+segment_index = frozenset((type_of_property, region) for type_of_property in ('house', 'apartment') for region in valid_regions)
+
+# Models that score a row in a few microseconds, fast enough to be called on the event loop
+compiled_model_types = (CompiledLinearModel, CompiledTreeEnsemble)
+
+def parse_fast_property(body):
+    """
+    Validates a property sent to the JSON predict endpoint and extracts its features.
+
+    This applies the same rules as the Data model (a known property type and region, and non-negative
+    numbers for the features) in a single pass, without building a Pydantic model.
+
+    Parameters:
+    body (dict): The decoded JSON body.
+
+    Returns:
+    tuple: The (type_of_property, region) segment, or None if the property is invalid, the features, in the
+    order of feature_names, and the list of errors.
+    """
+    # The features of every request get their own array, so concurrent requests never share one
+    features = np.empty(len(feature_names), dtype=np.float64)
+
+    if not isinstance(body, dict):
+        return None, features, ["body: Input should be a JSON object"]
+
+    errors = []
+    segment = (body.get('type_of_property'), body.get('region'))
+    try:
+        valid_segment = segment in segment_index
+    except TypeError:
+        # The property type or the region is not hashable (e.g. a list)
+        valid_segment = False
+    if not valid_segment:
+        errors.append("type_of_property, region: Input should be 'house' or 'apartment' and one of " + ', '.join(valid_regions))
+
+    for i, name in enumerate(feature_names):
+        value = body.get(name)
+        # Booleans are ints in Python, but not numbers in JSON. NaN fails the comparison like in the Data model
+        if type(value) is not float and type(value) is not int or not value >= 0:
+            errors.append(f"{name}: Input should be a number greater than or equal to 0")
+        else:
+            features[i] = value
+
+    return (segment if not errors else None), features, errors
+
+def orjson_response(status_code, content):
+    """
+    Returns a JSON response serialized with orjson.
+
+    Parameters:
+    status_code (int): The HTTP status code.
+    content (dict): The body of the response.
+
+    Returns:
+    fastapi.Response: The response.
+    """
+    return Response(content=orjson.dumps(content), status_code=status_code, media_type="application/json")
+
+# Define a JSON predict ("/predict/json") POST endpoint, a low-overhead version of /predict.
+# The body is decoded with orjson and validated once, and a compiled model is called on the event loop:
+# it scores one row in a few microseconds, less than the hand-off to the thread pool would cost. Pickled
+# models (MODEL_FORMAT=pickle) are much slower, and are called in the thread pool like in /predict
+@app.post("/predict/json", status_code=201)
+async def predict_price_json(request: Request):
+    # Decode the JSON body
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        return orjson_response(400, {"detail": f"Invalid JSON body: {str(e)}."})
+
+    # Validate the property and extract its features
+    segment, features, errors = parse_fast_property(body)
+    if segment is None:
+        return orjson_response(422, {"detail": f"Invalid property data: {'; '.join(errors)}"})
+
+    # Read the generation of the model before getting it, so a prediction made while it is reloaded is not cached
+    generation = prediction_cache.generation(segment) if prediction_cache is not None else None
+
+    # Get the model from the registry, reading a model that is not loaded yet in the thread pool
+    model = model_registry.peek(*segment)
+    if model is None:
+        model = await run_in_threadpool(model_registry.get, *segment)
+    if model is None:
+        metrics.count_request(segment, 404)
+        return orjson_response(
+            404, {"detail": f"No model found for property type '{segment[0]}' and region '{segment[1]}'."}
+        )
+
+    try:
+        if prediction_cache is not None:
+            prediction = prediction_cache.get(segment, features)
+            if prediction is not None:
+                metrics.count_request(segment, 201)
+                return orjson_response(201, {"prediction price in euro": prediction})
+
+        if micro_batcher is not None:
+            prediction = float(await micro_batcher.submit(model, features))
+        elif isinstance(model, compiled_model_types):
+            prediction = float(model.predict(features.reshape(1, -1))[0])
+        else:
+            prediction = float((await run_in_threadpool(model.predict, features.reshape(1, -1)))[0])
+
+        if prediction_cache is not None:
+            prediction_cache.put(segment, features, prediction, generation)
+
+        metrics.count_request(segment, 201)
+        return orjson_response(201, {"prediction price in euro": prediction})
+
+    except Exception as e:
+        # Log and count the failure, and return a 500 error with the details of the exception
+        logger.exception("Prediction failed for property type '%s' and region '%s'", *segment)
+        metrics.count_error(segment, e)
+        metrics.count_request(segment, 500)
+        return orjson_response(500, {"detail": f"An error occurred during prediction: {str(e)}."})
+
+def group_rows(rows):
+    """
+    Validates many properties one by one and groups the valid ones by (type_of_property, region).
+
+    Parameters:
+    rows (list): The properties, each one a dictionary with the fields of the Data model.
+
+    Returns:
+    tuple: One result per input row, in input order, which is a dictionary with the 422 status and the error
+    detail for an invalid row and None otherwise, and the positions and feature matrix of the valid rows of
+    every segment.
+    """
+    results = [None] * len(rows)
+
+    # Validate the rows and group their positions and features by segment
+    groups = {}
+    for i, row in enumerate(rows):
+        try:
+            property = Data.model_validate(row)
+        except ValidationError as e:
+            errors = '; '.join(f"{'.'.join(map(str, error['loc'])) or 'row'}: {error['msg']}" for error in e.errors())
+            results[i] = {"status": 422, "detail": f"Invalid property data: {errors}"}
+            continue
+
+        positions, features = groups.setdefault((property.type_of_property, property.region), ([], []))
+        positions.append(i)
+        features.append([getattr(property, feat) for feat in feature_names])
+
+    groups = {segment: (positions, np.array(features, dtype=np.float64)) for segment, (positions, features) in groups.items()}
+
+    return results, groups
+
+def predict_rows(rows):
+    """
+    Predicts the price of many properties, calling each segment model only once.
+
+    The rows are validated and grouped by segment with group_rows, and the features of each group are
+    passed to the model of the segment in one predict call. Rows that are invalid or that belong to a
+    segment without a model get an error instead of a prediction.
+
+    Parameters:
+    rows (list): The properties to price, each one a dictionary with the fields of the Data model.
+
+    Returns:
+    list: One result per input row, in input order. Each result is a dictionary with the HTTP status of the
+    row and either the predicted price (201) or the error detail: 422 for an invalid row, 404 for a row of a
+    segment without a model and 500 when the model call failed.
+    """
+    results, groups = group_rows(rows)
+
+    # Score each segment with a single call to its model
+    for (type_of_property, region), (positions, features) in groups.items():
+        model = model_registry.get(type_of_property, region)
+
+        if model is None:
+            error = {"status": 404, "detail": f"No model found for property type '{type_of_property}' and region '{region}'."}
+            for i in positions:
+                results[i] = error
+            continue
+
+        try:
+            predictions = model.predict(features)
+        except Exception as e:
+            error = {"status": 500, "detail": f"An error occurred during prediction: {str(e)}."}
+            for i in positions:
+                results[i] = error
+            continue
+
+        for i, prediction in zip(positions, predictions.tolist()):
+            results[i] = {"status": 201, "prediction price in euro": prediction}
+
+    return results
+
+# Define a batch predict ("/predict/batch") POST endpoint
+@app.post("/predict/batch", status_code=201)
+async def predict_batch(request: Request):
+    body = await request.body()
+
+    # Accept either a JSON array or newline-delimited JSON (one property per line)
+    try:
+        if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+            rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            rows = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {str(e)}.")
+
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="The body must be a JSON array or newline-delimited JSON objects.")
+
+    # Run the validation and the model calls outside of the event loop
+    predictions = await run_in_threadpool(predict_rows, rows)
+
+    return {"predictions": predictions}
+
+def find_comparables(rows, k):
+    """
+    Finds the K most similar listings of many properties, querying each segment only once.
+
+    The index of the listings is read, or read again if its file changed, from comparables_file. Like
+    predict_rows, the rows are validated and grouped by segment with group_rows, and the features of each
+    group are looked up in the index of the segment in a single batch query.
+
+    Parameters:
+    rows (list): The properties, each one a dictionary with the fields of the Data model.
+    k (int): The number of listings returned per property.
+
+    Returns:
+    list: One result per input row, in input order, like predict_rows. Each result is a dictionary with the
+    HTTP status of the row and either the comparable listings, from the closest one (200), or the error
+    detail: 422 for an invalid row and 404 for a row of a segment without listings. None if there is no
+    index of the listings.
+    """
+    index = comparables_file.get()
+    if index is None:
+        return None
+
+    results, groups = group_rows(rows)
+
+    # Look up the listings of each segment with a single query
+    for (type_of_property, region), (positions, features) in groups.items():
+        found = index.query(type_of_property, region, features, k)
+
+        if found is None:
+            error = {"status": 404, "detail": f"No listings found for property type '{type_of_property}' and region '{region}'."}
+            for i in positions:
+                results[i] = error
+            continue
+
+        for i, listing_rows, distances in zip(positions, *found):
+            results[i] = {"status": 200, "comparables": [index.listing(row, distance, feature_names)
+                                                         for row, distance in zip(listing_rows, distances)]}
+
+    return results
+
+# Define a comparables ("/comparables") POST endpoint
+@app.post("/comparables")
+async def read_comparables(request: Request, k: int = 5):
+    if not 1 <= k <= max_comparables:
+        return orjson_response(422, {"detail": f"k must be between 1 and {max_comparables}."})
+
+    # Accept either one property (a JSON object) or many properties (a JSON array)
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        return orjson_response(400, {"detail": f"Invalid JSON body: {str(e)}."})
+
+    # Run the check of the index file, the validation and the queries outside of the event loop
+    rows = body if isinstance(body, list) else [body]
+    results = await run_in_threadpool(find_comparables, rows, k)
+    if results is None:
+        return orjson_response(
+            503, {"detail": "The comparable listings are not available. Build them with python -m src.comparables."}
+        )
+
+    if isinstance(body, list):
+        return orjson_response(200, {"results": results})
+
+    # A single property gets the status of its result as the status of the response: 422 if it is invalid,
+    # 404 if its segment has no listings
+    result = dict(results[0])
+    return orjson_response(result.pop("status"), result)
+
+# Define a models ("/models") GET endpoint
+@app.get("/models")
+def read_models():
+    # Return the load times and hit counts of the models in the registry
+    return model_registry.stats()
+
+# Define a prediction cache statistics ("/cache") GET endpoint
+@app.get("/cache")
+def read_cache():
+    # Return the size and hit counts of the prediction cache, or null when it is disabled
+    return prediction_cache.stats() if prediction_cache is not None else None
+
+def parse_bedrooms(value):
+    """
+    Parses the number of bedrooms of a /stats query.
+
+    Parameters:
+    value (str): A bedroom bucket label ('0' to '4', '5+' or 'unknown') or a whole number of bedrooms (e.g. '7' or '3.0').
+
+    Returns:
+    str or int: The label, or the number of bedrooms, which the cube maps to its bucket. None if the value is invalid.
+    """
+    if value in BEDROOM_BUCKETS or value == UNKNOWN:
+        return value
+
+    try:
+        bedrooms = float(value)
+    except ValueError:
+        return None
+
+    if not (bedrooms >= 0 and bedrooms.is_integer()):
+        return None
+    return int(bedrooms)
+
+# Define a market statistics ("/stats") GET endpoint
+@app.get("/stats")
+def read_stats(region: str = None, type_of_property: str = None, subtype: str = None, bedrooms: str = None):
+    cube = stats_file.get()
+    if cube is None:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "The market statistics are not available. Build them with python -m src.market_stats."}
+        )
+
+    if bedrooms is not None:
+        bedrooms = parse_bedrooms(bedrooms)
+        if bedrooms is None:
+            return JSONResponse(
+                status_code=422,
+                content={"detail": f"Invalid bedrooms. Must be a whole number of bedrooms or one of {', '.join(BEDROOM_BUCKETS + (UNKNOWN,))}."}
+            )
+
+    # Look up the precomputed cell of the given values, the omitted ones being aggregated over
+    stats = cube.query(region, type_of_property, subtype, bedrooms)
+    if stats is None:
+        return JSONResponse(status_code=404, content={"detail": "No property matches the given region, type_of_property, subtype and bedrooms."})
+
+    return stats
+
+# Define a metrics ("/metrics") GET endpoint
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    # Return the stage latencies, request counts, model loads, micro-batches and memory usage in the Prometheus text format
+    batching = micro_batcher.stats() if micro_batcher is not None else None
+    return PlainTextResponse(metrics.render(batching), media_type="text/plain; version=0.0.4")
+
+# Define the sampling profiler ("/profiler") endpoints, only when the profiler is enabled
+if os.environ.get('PROFILER_ENABLED'):
+    @app.post("/profiler/start")
+    def start_profiler():
+        # Start sampling the stacks of the API threads
+        profiler.start()
+        return profiler.report(limit=0)
+
+    @app.post("/profiler/stop")
+    def stop_profiler():
+        # Stop sampling and return the most frequent stacks
+        profiler.stop()
+        return profiler.report()
+
+    @app.get("/profiler")
+    def read_profiler():
+        # Return the most frequent stacks sampled so far
+        return profiler.report()
@@ -0,0 +1,389 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import httpx
+import numpy as np
+
+from src.data_preprocessing import load_and_clean_data
+from src.model_registry import ModelRegistry
+
+# Columns of the cleaned data used for each field of the /predict form
+FORM_COLUMNS = {
+    'number_of_bedrooms': 'Number of bedrooms',
+    'living_area': 'Living area',
+    'terrace_area': 'Terrace area',
+    'surface_of_land': 'Surface of the land(or plot of land)',
+    'number_of_facades': 'Number of facades',
+}
+
+# How each endpoint is called with a property: the HTTP path and the keyword arguments of httpx's post
+ENDPOINTS = {
+    'predict': lambda property: ('/predict', {'data': property}),
+    'predict_json': lambda property: ('/predict/json', {'json': property}),
+}
+
+
+def make_properties(data_path, count, seed=42, models_dir='./models'):
+    """
+    Samples synthetic /predict requests from the property data, evenly spread over the segments the API can serve.
+
+    Segments whose model does not take the features sent by the API are skipped (e.g. the house models
+    trained with an extra feature), as every request to them fails and would only measure the error path.
+
+    Parameters:
+    data_path (str): The path of the property data csv file.
+    count (int): The number of properties to sample.
+    seed (int): The seed of the random generator.
+    models_dir (str): The directory that contains the models.
+
+    Returns:
+    tuple: The properties, as dictionaries with the fields of the /predict form, and the skipped
+    segments, as '{property_type}_{region}' names.
+    """
+    df = load_and_clean_data(data_path)
+    registry = ModelRegistry(models_dir)
+
+    segments = []
+    skipped = []
+    for (property_type, region), group_df in df.groupby(['Type of property', 'Region'], observed=True):
+        model = registry.get(property_type, region)
+        if model is not None and model.n_features_in_ == len(FORM_COLUMNS):
+            segments.append(((property_type, region), group_df))
+        else:
+            skipped.append(f'{property_type}_{region}')
+
+    rng = np.random.default_rng(seed)
+
+    properties = []
+    for i in range(count):
+        (property_type, region), group_df = segments[i % len(segments)]
+        row = group_df.iloc[rng.integers(len(group_df))]
+
+        property = {'type_of_property': property_type, 'region': region}
+        for field, column in FORM_COLUMNS.items():
+            value = row[column]
+            property[field] = 0.0 if np.isnan(value) else float(value)
+        properties.append(property)
+
+    return properties, skipped
+
+
+def process_cpu_time(pid):
+    """
+    Returns the CPU time used so far by another process, from /proc (Linux only).
+
+    Parameters:
+    pid (int): The process id.
+
+    Returns:
+    float: The user and system CPU time in seconds, or None if it is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces, so the fields are counted from the closing parenthesis
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def summarize_latencies(latencies, seconds, errors, cpu_seconds=None):
+    """
+    Summarizes the latencies of a load test run.
+
+    Parameters:
+    latencies (list): The latency of every request, in seconds.
+    seconds (float): The wall-clock time of the run.
+    errors (int): The number of requests that did not succeed.
+    cpu_seconds (float): The CPU time used by the API during the run, or None if it was not measured.
+
+    Returns:
+    dict: The number of requests and errors, the throughput, the p50/p95/p99/max latency in milliseconds
+    and the CPU time per request in microseconds.
+    """
+    latencies_ms = np.array(latencies) * 1000
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': seconds,
+        'throughput_rps': len(latencies) / seconds,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'max_ms': float(latencies_ms.max()),
+        'cpu_us_per_request': cpu_seconds / len(latencies) * 1e6 if cpu_seconds is not None else None,
+    }
+
+
+async def run_load(client, endpoint, properties, concurrency, cpu_clock=None):
+    """
+    Sends every property to an endpoint, with a fixed number of requests in flight.
+
+    Parameters:
+    client (httpx.AsyncClient): The client connected to the API.
+    endpoint (str): The name of the endpoint in ENDPOINTS.
+    properties (list): The properties to send.
+    concurrency (int): The number of concurrent requests.
+    cpu_clock (callable): Function that returns the CPU time used by the API so far, or None.
+
+    Returns:
+    dict: The summary of the run, as returned by summarize_latencies.
+    """
+    latencies = []
+    errors = 0
+    queue = iter(properties)
+
+    async def worker():
+        nonlocal errors
+        for property in queue:
+            path, kwargs = ENDPOINTS[endpoint](property)
+            start = time.perf_counter()
+            response = await client.post(path, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    cpu_start = cpu_clock() if cpu_clock is not None else None
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+    cpu_end = cpu_clock() if cpu_clock is not None else None
+
+    cpu_seconds = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+
+    return summarize_latencies(latencies, seconds, errors, cpu_seconds)
+
+
+async def run_levels(client, endpoint, properties, concurrency_levels, warmup, cpu_clock=None):
+    """
+    Runs the load test at every concurrency level, after a warm-up run.
+
+    Parameters:
+    client (httpx.AsyncClient): The client connected to the API.
+    endpoint (str): The name of the endpoint in ENDPOINTS.
+    properties (list): The properties to send at each level.
+    concurrency_levels (list): The numbers of concurrent requests.
+    warmup (int): The number of requests sent before measuring.
+    cpu_clock (callable): Function that returns the CPU time used by the API so far, or None.
+
+    Returns:
+    list: The summary of every level, with its concurrency.
+    """
+    await run_load(client, endpoint, properties[:warmup], 1)
+
+    results = []
+    for concurrency in concurrency_levels:
+        result = await run_load(client, endpoint, properties, concurrency, cpu_clock)
+        results.append(dict(result, concurrency=concurrency))
+        print(f"  concurrency {concurrency:>4}: {result['throughput_rps']:>8.1f} req/s, "
+              f"p50 {result['p50_ms']:.2f} ms, p95 {result['p95_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms"
+              f"{', CPU %.0f us/req' % result['cpu_us_per_request'] if result['cpu_us_per_request'] is not None else ''}"
+              f"{', %d errors' % result['errors'] if result['errors'] else ''}")
+
+    return results
+
+
+async def bench_in_process(endpoint, properties, concurrency_levels, warmup):
+    """
+    Load tests the FastAPI app in the benchmark process, through an ASGI transport (no network).
+
+    The CPU time per request is the one of the whole benchmark process, so it includes the client.
+
+    Parameters:
+    endpoint (str): The name of the endpoint in ENDPOINTS.
+    properties (list): The properties to send at each level.
+    concurrency_levels (list): The numbers of concurrent requests.
+    warmup (int): The number of requests sent before measuring.
+
+    Returns:
+    list: The summary of every concurrency level.
+    """
+    import app
+
+    transport = httpx.ASGITransport(app=app.app)
+
+    # Run the startup events, like uvicorn does, so that the models are preloaded
+    async with app.app.router.lifespan_context(app.app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            return await run_levels(client, endpoint, properties, concurrency_levels, warmup, time.process_time)
+
+
+async def bench_uvicorn(endpoint, properties, concurrency_levels, warmup, workers):
+    """
+    Load tests the API served by a local uvicorn instance, over HTTP.
+
+    The CPU time per request is the one of the uvicorn process, so it is only measured with a single worker.
+
+    Parameters:
+    endpoint (str): The name of the endpoint in ENDPOINTS.
+    properties (list): The properties to send at each level.
+    concurrency_levels (list): The numbers of concurrent requests.
+    warmup (int): The number of requests sent before measuring.
+    workers (int): The number of uvicorn worker processes.
+
+    Returns:
+    list: The summary of every concurrency level.
+    """
+    # Pick a free port for the server
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(workers), '--log-level', 'warning'],
+    )
+
+    try:
+        limits = httpx.Limits(max_connections=max(concurrency_levels))
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', limits=limits, timeout=60) as client:
+            # Wait until the server accepts requests
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    await client.get('/')
+                    break
+                except httpx.TransportError:
+                    if time.monotonic() > deadline or server.poll() is not None:
+                        raise RuntimeError('The uvicorn server did not start.')
+                    await asyncio.sleep(0.1)
+
+            cpu_clock = (lambda: process_cpu_time(server.pid)) if workers == 1 else None
+            return await run_levels(client, endpoint, properties, concurrency_levels, warmup, cpu_clock)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_stages(properties, repeat):
+    """
+    Measures the time spent in each stage of a /predict request, outside of the HTTP layer.
+
+    The stages are the same as in the handler: validation of the request data, model lookup (and
+    loading, on a registry miss), feature assembly and the model call. The single pass validation and
+    feature assembly of /predict/json is measured as well, for comparison.
+
+    Parameters:
+    properties (list): The properties to predict.
+    repeat (int): The number of properties predicted.
+
+    Returns:
+    dict: For every stage, its mean and p99 time in microseconds.
+    """
+    import app
+
+    stages = {'validation': [], 'model_lookup': [], 'feature_assembly': [], 'model_predict': [],
+              'json_validation_and_assembly': []}
+
+    for i in range(repeat):
+        property = properties[i % len(properties)]
+
+        start = time.perf_counter()
+        data = app.Data(**property)
+        validated = time.perf_counter()
+        model = app.model_registry.get(data.type_of_property, data.region)
+        looked_up = time.perf_counter()
+        features = np.array([data.dict()[feat] for feat in app.feature_names]).reshape(1, -1)
+        assembled = time.perf_counter()
+        model.predict(features)
+        predicted = time.perf_counter()
+        app.parse_fast_property(property)
+        parsed = time.perf_counter()
+
+        stages['validation'].append(validated - start)
+        stages['model_lookup'].append(looked_up - validated)
+        stages['feature_assembly'].append(assembled - looked_up)
+        stages['model_predict'].append(predicted - assembled)
+        stages['json_validation_and_assembly'].append(parsed - predicted)
+
+    return {
+        stage: {'mean_us': float(np.mean(times) * 1e6), 'p99_us': float(np.percentile(times, 99) * 1e6)}
+        for stage, times in stages.items()
+    }
+
+
+def git_commit():
+    """
+    Returns the current git commit of the repository.
+
+    Returns:
+    str: The hash of the commit, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    """
+    Command line entry point that load tests the prediction API: python -m benchmarks.bench_api
+
+    Parameters:
+    argv (list): The command line arguments. None uses sys.argv.
+
+    Returns:
+    None
+    """
+    parser = argparse.ArgumentParser(description='Load test the prediction API and report its throughput and latency.')
+    parser.add_argument('--data', default='./data/property_data.csv', help='path of the property data csv file')
+    parser.add_argument('--endpoint', choices=sorted(ENDPOINTS), nargs='+', default=['predict'],
+                        help='endpoints to load test, one after the other (e.g. predict predict_json to compare them)')
+    parser.add_argument('--mode', choices=['in-process', 'uvicorn', 'both'], default='both', help='how the API is served')
+    parser.add_argument('--requests', type=int, default=2000, help='number of requests per concurrency level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64], help='concurrency levels')
+    parser.add_argument('--warmup', type=int, default=100, help='number of requests sent before measuring')
+    parser.add_argument('--workers', type=int, default=1, help='number of uvicorn workers')
+    parser.add_argument('--output', default='./benchmarks/results/bench_api.json', help='path of the JSON results file')
+    args = parser.parse_args(argv)
+
+    properties, skipped = make_properties(args.data, args.requests)
+    if skipped:
+        print(f"Skipped {len(skipped)} segments whose model does not take the features of the API: {', '.join(skipped)}")
+
+    results = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'requests': args.requests,
+        'skipped_segments': skipped,
+        'environment': {name: value for name, value in os.environ.items()
+                        if name.startswith(('MODEL', 'PREDICT'))},
+    }
+
+    print('Stages of a /predict request:')
+    results['stages'] = bench_stages(properties, args.requests)
+    for stage, timing in results['stages'].items():
+        print(f"  {stage:<28} mean {timing['mean_us']:>8.1f} us, p99 {timing['p99_us']:>8.1f} us")
+
+    results['endpoints'] = {}
+    for endpoint in args.endpoint:
+        endpoint_results = results['endpoints'][endpoint] = {}
+
+        if args.mode in ('in-process', 'both'):
+            print(f'{endpoint}, in-process (ASGI transport):')
+            endpoint_results['in_process'] = asyncio.run(
+                bench_in_process(endpoint, properties, args.concurrency, args.warmup))
+
+        if args.mode in ('uvicorn', 'both'):
+            print(f'{endpoint}, uvicorn ({args.workers} worker(s)):')
+            endpoint_results['uvicorn'] = asyncio.run(
+                bench_uvicorn(endpoint, properties, args.concurrency, args.warmup, args.workers))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+from src.data_preprocessing import get_region, map_regions
+
+
+def make_zip_codes(rows, seed=42):
+    """
+    Generates a column of random zip codes, with some missing, out of range and non-integer values.
+
+    Parameters:
+    rows (int): The number of zip codes.
+    seed (int): The seed of the random generator.
+
+    Returns:
+    pandas.Series: The zip codes, as floats like in the csv file.
+    """
+    rng = np.random.default_rng(seed)
+    zip_codes = rng.integers(0, 11000, size=rows).astype(np.float64)
+
+    # Make 1% of the zip codes non-integers, half of them between the last zip code of a range and the next one
+    fractional = np.flatnonzero(rng.random(rows) < 0.01)
+    zip_codes[fractional] += rng.choice([0.5, 0.99], size=len(fractional))
+    boundaries = fractional[:len(fractional) // 2]
+    zip_codes[boundaries] = rng.choice([1299.5, 1499.5, 1999.5, 2999.5, 6599.5, 6999.5], size=len(boundaries))
+
+    # Make 1% of the zip codes missing
+    zip_codes[rng.random(rows) < 0.01] = np.nan
+
+    return pd.Series(zip_codes, name='Zip code')
+
+
+def run_benchmark(rows, repeat=3):
+    """
+    Compares the row by row get_region mapping with the vectorized map_regions mapping.
+
+    Parameters:
+    rows (int): The number of zip codes to map.
+    repeat (int): The number of runs of each mapping; the best time is kept.
+
+    Returns:
+    dict: The best time of each mapping, in seconds, and the speedup of map_regions.
+    """
+    zip_codes = make_zip_codes(rows)
+
+    apply_seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        expected = zip_codes.apply(get_region)
+        apply_seconds.append(time.perf_counter() - start)
+
+    vectorized_seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        actual = map_regions(zip_codes)
+        vectorized_seconds.append(time.perf_counter() - start)
+
+    # Both mappings must agree on every zip code, including the ones without a region
+    if not expected.fillna('').equals(pd.Series(actual.astype(object)).fillna('')):
+        raise AssertionError('map_regions and get_region disagree.')
+
+    return {
+        'apply_seconds': min(apply_seconds),
+        'vectorized_seconds': min(vectorized_seconds),
+        'speedup': min(apply_seconds) / min(vectorized_seconds),
+    }
+
+
+def main(argv=None):
+    """
+    Command line entry point that benchmarks the zip code to region mapping: python -m benchmarks.bench_region_mapping
+
+    Parameters:
+    argv (list): The command line arguments. None uses sys.argv.
+
+    Returns:
+    None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the zip code to region mapping.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000], help='numbers of zip codes to map')
+    args = parser.parse_args(argv)
+
+    print(f"{'Rows':>10} {'apply (s)':>10} {'vectorized (s)':>15} {'speedup':>8}")
+    for rows in args.rows:
+        result = run_benchmark(rows)
+        print(f"{rows:>10} {result['apply_seconds']:>10.4f} {result['vectorized_seconds']:>15.4f} {result['speedup']:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main()
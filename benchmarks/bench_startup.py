@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+from src.model_store import build_model_store
+
+# Modules that should not be loaded by a serving worker
+HEAVY_MODULES = ['pandas', 'sklearn', 'xgboost', 'scipy', 'matplotlib', 'seaborn']
+
+# What each profile imports and runs to become ready, and the environment it runs with
+PROFILES = {
+    'serving_compiled': {
+        'code': 'import app; ready(); app.load_models()',
+        'environment': {'MODEL_FORMAT': 'compiled'},
+    },
+    'serving_store': {
+        'code': 'import app; ready(); app.load_models()',
+        'environment': {'MODEL_FORMAT': 'store', 'MODEL_STORE_PATH': './benchmarks/results/model_store.bin'},
+    },
+    'serving_pickle': {
+        'code': 'import app; ready(); app.load_models()',
+        'environment': {'MODEL_FORMAT': 'pickle'},
+    },
+    'training': {
+        'code': 'import src.train, src.model_selection, src.data_visualization; ready()',
+        'environment': {},
+    },
+}
+
+# Run in a fresh interpreter: times the profile code and reports the memory and the loaded modules as JSON
+MEASURE = '''
+import json, sys, time
+start = time.perf_counter()
+marks = {}
+def ready():
+    marks['import_seconds'] = time.perf_counter() - start
+%s
+from src.metrics import process_memory
+print(json.dumps(dict(
+    marks,
+    ready_seconds=time.perf_counter() - start,
+    rss_bytes=process_memory()['resident'],
+    shared_bytes=process_memory()['shared'],
+    peak_rss_bytes=process_memory()['peak_resident'],
+    modules=len(sys.modules),
+    heavy_modules=[name for name in %r if name in sys.modules],
+)))
+'''
+
+
+def measure_profile(profile, repeat):
+    """
+    Starts a fresh interpreter for a profile several times and measures its startup.
+
+    Parameters:
+    profile (str): The name of the profile in PROFILES.
+    repeat (int): The number of interpreters started.
+
+    Returns:
+    dict: The median import time, time until ready and process wall time in seconds, the median resident,
+    private (resident but not shared with other processes) and peak resident memory in megabytes, the number
+    of loaded modules, and the heavy modules that were loaded.
+    """
+    code = MEASURE % (PROFILES[profile]['code'], HEAVY_MODULES)
+    environment = dict(os.environ, **PROFILES[profile]['environment'])
+
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], env=environment, capture_output=True, text=True,
+                                check=True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        run['process_seconds'] = time.perf_counter() - start
+        runs.append(run)
+
+    return {
+        'import_seconds': float(np.median([run['import_seconds'] for run in runs])),
+        'ready_seconds': float(np.median([run['ready_seconds'] for run in runs])),
+        'process_seconds': float(np.median([run['process_seconds'] for run in runs])),
+        'rss_mb': float(np.median([run['rss_bytes'] for run in runs])) / 2 ** 20,
+        'private_mb': float(np.median([run['rss_bytes'] - run['shared_bytes'] for run in runs])) / 2 ** 20,
+        'peak_rss_mb': float(np.median([run['peak_rss_bytes'] for run in runs])) / 2 ** 20,
+        'modules': runs[-1]['modules'],
+        'heavy_modules': runs[-1]['heavy_modules'],
+    }
+
+
+def slowest_imports(code, environment, count=10):
+    """
+    Returns the modules imported by the last module imported by the code (e.g. by app for 'import app')
+    that take the longest to import, according to python -X importtime.
+
+    Parameters:
+    code (str): The code to run.
+    environment (dict): The environment variables to add.
+    count (int): The number of modules returned.
+
+    Returns:
+    list: The slowest imports, with their cumulative import time in milliseconds.
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=dict(os.environ, **environment),
+                            capture_output=True, text=True, check=True).stderr
+
+    imports = []
+    children = []
+    for line in stderr.splitlines():
+        # Lines look like 'import time:   self [us] | cumulative | module', nested modules being indented by two
+        # spaces per level, and listed before the module that imports them
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        depth = (len(module) - len(module.lstrip())) // 2
+        if depth == 1:
+            children.append({'module': module.strip(), 'cumulative_ms': int(cumulative) / 1000})
+        elif depth == 0:
+            imports, children = children, []
+
+    return sorted(imports, key=lambda entry: entry['cumulative_ms'], reverse=True)[:count]
+
+
+def main(argv=None):
+    """
+    Command line entry point that measures the startup of the API and training modules: python -m benchmarks.bench_startup
+
+    Parameters:
+    argv (list): The command line arguments. None uses sys.argv.
+
+    Returns:
+    None
+    """
+    parser = argparse.ArgumentParser(description='Measure the import time and memory of the API and training modules.')
+    parser.add_argument('--repeat', type=int, default=5, help='number of interpreters started per profile')
+    parser.add_argument('--output', default='./benchmarks/results/bench_startup.json', help='path of the JSON results file')
+    args = parser.parse_args(argv)
+
+    results = {'python': sys.version.split()[0], 'profiles': {}}
+
+    # Pack the compiled models into the model store served by the serving_store profile
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    build_model_store('./models', PROFILES['serving_store']['environment']['MODEL_STORE_PATH'])
+
+    print(f"{'Profile':<18} {'Import':>9} {'Ready':>9} {'Process':>9} {'RSS':>9} {'Private':>9} {'Peak RSS':>9}  Heavy modules")
+    for profile in PROFILES:
+        result = results['profiles'][profile] = measure_profile(profile, args.repeat)
+        print(f"{profile:<18} {result['import_seconds'] * 1000:>6.0f} ms {result['ready_seconds'] * 1000:>6.0f} ms "
+              f"{result['process_seconds'] * 1000:>6.0f} ms {result['rss_mb']:>6.1f} MB {result['private_mb']:>6.1f} MB "
+              f"{result['peak_rss_mb']:>6.1f} MB  "
+              f"{', '.join(result['heavy_modules']) or 'none'}")
+
+    results['slowest_serving_imports'] = slowest_imports('import app', PROFILES['serving_compiled']['environment'])
+    print('Slowest imports of the API:')
+    for entry in results['slowest_serving_imports']:
+        print(f"  {entry['module']:<24} {entry['cumulative_ms']:>7.1f} ms")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
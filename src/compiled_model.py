@@ -0,0 +1,211 @@
+import os
+import numpy as np
+
+
+class CompiledLinearModel:
+    """
+    Pure NumPy evaluator for a linear regression model exported to its raw coefficients.
+
+    Parameters:
+    coef (numpy.ndarray): The coefficient of every feature.
+    intercept (float): The intercept of the model.
+    """
+
+    def __init__(self, coef, intercept):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+        self.n_features_in_ = self.coef.shape[0]
+
+    def predict(self, X):
+        """
+        Predicts the target for every row of X.
+
+        Parameters:
+        X (numpy.ndarray): The feature matrix, one row per property.
+
+        Returns:
+        numpy.ndarray: The predictions.
+        """
+        X = _check_features(X, self.n_features_in_)
+        return X @ self.coef + self.intercept
+
+
+class CompiledTreeEnsemble:
+    """
+    Pure NumPy evaluator for a gradient boosted tree ensemble exported to a flat node table.
+
+    The nodes of all trees are stored in parallel arrays. For an internal node, feature and threshold
+    describe the split, left and right are the global indices of its children and default_left tells which
+    way missing values go. For a leaf, left and right are -1 and value holds the leaf output. Like XGBoost,
+    a row goes to the left child when its feature value is strictly smaller than the threshold, and features
+    and thresholds are compared in single precision.
+
+    Parameters:
+    roots (numpy.ndarray): The global index of the root node of every tree.
+    left (numpy.ndarray): The global index of the left child of every node, or -1 for leaves.
+    right (numpy.ndarray): The global index of the right child of every node, or -1 for leaves.
+    feature (numpy.ndarray): The index of the feature every node splits on.
+    threshold (numpy.ndarray): The split threshold of every node.
+    default_left (numpy.ndarray): Whether missing values go to the left child of every node.
+    value (numpy.ndarray): The output of every leaf node.
+    base_score (float): The initial prediction the leaf outputs are added to.
+    n_features (int): The number of features the model expects.
+    next_left, next_right, depth: Optional arrays and depth precomputed by _prepare, e.g. read from a
+    memory-mapped model store, so they are not computed again.
+    """
+
+    def __init__(self, roots, left, right, feature, threshold, default_left, value, base_score, n_features,
+                 next_left=None, next_right=None, depth=None):
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float32)
+        self.default_left = np.asarray(default_left, dtype=np.bool_)
+        self.value = np.asarray(value, dtype=np.float32)
+        self.base_score = float(base_score)
+        self.n_features_in_ = int(n_features)
+
+        if depth is None:
+            self._prepare()
+        else:
+            self._next_left = np.asarray(next_left, dtype=np.int32)
+            self._next_right = np.asarray(next_right, dtype=np.int32)
+            self._depth = int(depth)
+
+    def predict(self, X):
+        """
+        Predicts the target for every row of X.
+
+        All trees are walked at the same time for all rows, one tree level per step,
+        so the number of NumPy operations only depends on the depth of the deepest tree.
+
+        Parameters:
+        X (numpy.ndarray): The feature matrix, one row per property.
+
+        Returns:
+        numpy.ndarray: The predictions.
+        """
+        X = _check_features(X, self.n_features_in_).astype(np.float32)
+
+        # Current node of every (row, tree) pair, starting at the roots
+        nodes = np.broadcast_to(self.roots, (X.shape[0], self.roots.shape[0]))
+        rows = np.arange(X.shape[0])[:, None]
+
+        for _ in range(self._depth):
+            x = X[rows, self.feature[nodes]]
+
+            # Go left when the value is below the threshold, or when it is missing and the node defaults left
+            go_left = np.where(np.isnan(x), self.default_left[nodes], x < self.threshold[nodes])
+            nodes = np.where(go_left, self._next_left[nodes], self._next_right[nodes])
+
+        return self.value[nodes].sum(axis=1, dtype=np.float32) + np.float32(self.base_score)
+
+    def _prepare(self):
+        """
+        Precomputes the arrays used by predict.
+
+        Leaves point to themselves, so that rows that reach a leaf early stay there
+        while the other rows keep walking down their trees.
+
+        Returns:
+        None
+        """
+        is_leaf = self.left == -1
+        node_ids = np.arange(self.left.shape[0], dtype=np.int32)
+        self._next_left = np.where(is_leaf, node_ids, self.left)
+        self._next_right = np.where(is_leaf, node_ids, self.right)
+
+        # The number of steps needed to reach the deepest leaf of any tree
+        self._depth = 0
+        frontier = self.roots[~is_leaf[self.roots]]
+        while frontier.shape[0]:
+            self._depth += 1
+            children = np.concatenate([self.left[frontier], self.right[frontier]])
+            frontier = children[~is_leaf[children]]
+
+
+def save_compiled_model(path, compiled):
+    """
+    Saves a compiled model to a NumPy .npz archive that can be loaded without pickle.
+
+    The archive is written to a temporary file that then replaces the destination atomically,
+    so a model registry watching the file never reads a partially written model.
+
+    Parameters:
+    path (str): The destination path of the archive.
+    compiled (CompiledLinearModel or CompiledTreeEnsemble): The compiled model to save.
+
+    Returns:
+    None
+    """
+    if isinstance(compiled, CompiledLinearModel):
+        arrays = {'kind': np.array('linear'), 'coef': compiled.coef, 'intercept': np.array(compiled.intercept)}
+    elif isinstance(compiled, CompiledTreeEnsemble):
+        arrays = {
+            'kind': np.array('tree_ensemble'),
+            'roots': compiled.roots,
+            'left': compiled.left,
+            'right': compiled.right,
+            'feature': compiled.feature,
+            'threshold': compiled.threshold,
+            'default_left': compiled.default_left,
+            'value': compiled.value,
+            'base_score': np.array(compiled.base_score),
+            'n_features': np.array(compiled.n_features_in_),
+        }
+    else:
+        raise TypeError(f"Cannot save a model of type {type(compiled).__name__}.")
+
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+
+    with open(temporary_path, 'wb') as f:
+        np.savez(f, **arrays)
+
+    os.replace(temporary_path, path)
+
+
+def load_compiled_model(path):
+    """
+    Loads a compiled model saved by save_compiled_model.
+
+    Parameters:
+    path (str): The path of the .npz archive.
+
+    Returns:
+    CompiledLinearModel or CompiledTreeEnsemble: The compiled model.
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        kind = str(archive['kind'])
+
+        if kind == 'linear':
+            return CompiledLinearModel(archive['coef'], archive['intercept'])
+
+        if kind == 'tree_ensemble':
+            return CompiledTreeEnsemble(
+                archive['roots'], archive['left'], archive['right'], archive['feature'], archive['threshold'],
+                archive['default_left'], archive['value'], archive['base_score'], archive['n_features']
+            )
+
+    raise ValueError(f"Unknown compiled model kind '{kind}' in {path}.")
+
+
+def _check_features(X, n_features):
+    """
+    Converts X to a 2D float array and checks that it has the number of features the model expects.
+
+    Parameters:
+    X (array-like): The feature matrix.
+    n_features (int): The number of features the model expects.
+
+    Returns:
+    numpy.ndarray: The feature matrix as a 2D float64 array.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if X.ndim == 1:
+        X = X.reshape(1, -1)
+
+    if X.shape[1] != n_features:
+        raise ValueError(f"Feature shape mismatch, expected: {n_features}, got {X.shape[1]}")
+
+    return X
@@ -1,3 +1,6 @@
+import os
+import json
+import hashlib
 import pandas as pd
 import numpy as np
 
@@ -39,43 +42,423 @@ def get_region(zip_code):
     elif 9000 <= zip_code <= 9999:
         return 'East Flanders' 
 
-def load_and_clean_data(path):
+# Regions of Belgium, in the order of the categories of the 'Region' column
+REGIONS = ['Brussels-Capital', 'Walloon Brabant', 'Flemish Brabant', 'Antwerp', 'Limburg', 'Liege',
+           'Namur', 'Hainaut', 'Luxembourg', 'West Flanders', 'East Flanders']
+
+# Lookup table from every zip code between 0 and 9999 to the index of its region in REGIONS (-1 if it has none),
+# precomputed once from get_region so both always agree
+ZIP_CODE_REGIONS = np.array([REGIONS.index(region) if region is not None else -1
+                             for region in map(get_region, range(10000))], dtype=np.int8)
+
+def map_regions(zip_codes):
+    """
+    Get the region names of many zip codes at once.
+
+    This is the vectorized equivalent of applying get_region to every zip code: the zip codes are used as
+    indices into the precomputed ZIP_CODE_REGIONS lookup table, so the whole column is mapped in one pass.
+
+    Zip codes that are not integers get the same region as with get_region: a zip code is within one of its
+    ranges, whose bounds are integers, exactly when the integers just below and just above it are both within
+    that range (e.g. 1000.5 is in Brussels-Capital, but 1299.5 is between two ranges and has no region).
+
+    Parameters:
+    zip_codes (array-like): The zip codes, as numbers.
+
+    Returns:
+    pandas.Categorical: The region of every zip code, with the regions of REGIONS as categories.
+    Zip codes that are missing or outside the ranges of get_region are mapped to NaN.
+
+    """
+    zip_codes = np.asarray(zip_codes, dtype=np.float64)
+
+    # Only zip codes within the bounds of the lookup table can have a region
+    lower = np.floor(zip_codes)
+    upper = np.ceil(zip_codes)
+    valid = np.isfinite(zip_codes) & (lower >= 0) & (upper < len(ZIP_CODE_REGIONS))
+
+    codes = np.full(zip_codes.shape, -1, dtype=np.int8)
+    lower_codes = ZIP_CODE_REGIONS[lower[valid].astype(np.intp)]
+    upper_codes = ZIP_CODE_REGIONS[upper[valid].astype(np.intp)]
+    codes[valid] = np.where(lower_codes == upper_codes, lower_codes, -1)
+
+    return pd.Categorical.from_codes(codes, categories=REGIONS)
+
+# Columns of the raw csv file that are needed by the analysis, with the compact dtype they are read with
+# ('ID number' is only read to identify duplicate listings and is dropped afterwards)
+PROPERTY_DATA_DTYPES = {
+    'ID number': 'float64',
+    'Zip code': 'float32',
+    'Type of property': 'category',
+    'Price of property in euro': 'float32',
+    'Number of bedrooms': 'float32',
+    'Living area': 'float32',
+    'Terrace area': 'float32',
+    'Garden area': 'float32',
+    'Surface of the land(or plot of land)': 'float32',
+    'Number of facades': 'float32',
+}
+
+# Optional column that describes the property more precisely than 'Type of property' (e.g. 'villa')
+SUBTYPE_DTYPES = {'Subtype of property': 'category'}
+
+# Version of the cleaning logic, stored in the cache so that caches written by older versions are rebuilt
+CACHE_VERSION = 2
+
+def load_and_clean_data(path, use_cache=True, cache_dir=None, with_subtype=False):
     """
     Load the dataset from a csv file and perform initial cleaning operations.
 
     This function takes the path of a csv file as input, loads it into a pandas DataFrame, 
     and performs several cleaning operations such as dropping duplicates, adding a new column for 'Region' 
-    (derived from 'Zip code' using the get_region function), and removing unnecessary columns.
+    (derived from 'Zip code' using the map_regions function), and removing unnecessary columns.
+
+    Only the needed columns are read, with compact dtypes: 'Type of property' and 'Region' are categorical
+    and the numeric columns are float32. The cleaned DataFrame is cached in a columnar .npz file, keyed on the
+    size, modification time and hash of the csv file, so that the next calls load it without parsing the csv.
 
     Parameters:
     path (str): The file path to the csv data.
+    use_cache (bool): Whether to load the cleaned DataFrame from the cache and to write it to the cache.
+    cache_dir (str): The directory of the cache. By default, a '.cache' directory next to the csv file.
+    with_subtype (bool): Whether to also keep the categorical 'Subtype of property' column (e.g. for the market
+    statistics). It is not a model feature, so it is left out by default.
 
     Returns:
     pandas.DataFrame: A cleaned DataFrame ready for further preprocessing and analysis.
 
     """
-    # Load the DataFrame from the given csv file path
-    df = pd.read_csv(path)
+    if not use_cache:
+        return read_and_clean_csv(path, with_subtype)
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), '.cache')
+    cache_path = os.path.join(cache_dir, os.path.basename(path) + ('.subtype' if with_subtype else '') + '.npz')
+
+    # Return the cached DataFrame if it was built from the same version of the csv file
+    df = load_frame_cache(cache_path, path)
+    if df is not None:
+        return df
+
+    df = read_and_clean_csv(path, with_subtype)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    save_frame_cache(df, cache_path, path)
+
+    return df
+
+def read_and_clean_csv(path, with_subtype=False):
+    """
+    Read the needed columns of the csv file with compact dtypes and clean them.
+
+    Parameters:
+    path (str): The file path to the csv data.
+    with_subtype (bool): Whether to also read the 'Subtype of property' column.
+
+    Returns:
+    pandas.DataFrame: A cleaned DataFrame with the same columns as returned by load_and_clean_data.
+    """
+    # Load only the needed columns from the given csv file path, with explicit dtypes
+    dtypes = dict(PROPERTY_DATA_DTYPES, **SUBTYPE_DTYPES) if with_subtype else PROPERTY_DATA_DTYPES
+    df = pd.read_csv(path, usecols=list(dtypes), dtype=dtypes)
 
     # Drop duplicate rows from the DataFrame
     df = df.drop_duplicates()
 
     # Add a 'Region' column to the DataFrame
-    # The 'Region' values are determined by applying the get_region function to the 'Zip code' column
-    df['Region'] = df['Zip code'].apply(get_region)
-
-    # Define a list of columns that are unnecessary for the analysis
-    columns_to_drop = ['Zip code', 'Locality', 'Type of Sale', 'State of the building', 
-                       'Subtype of property', 'Garden', 'Swimming pool', 'Terrace', 
-                       'Kitchen', 'Raw num:', 'ID number', 'URL']
+    # The 'Region' values are determined by looking up every value of the 'Zip code' column at once
+    df['Region'] = map_regions(df['Zip code'])
 
-    # Drop the unnecessary columns from the DataFrame
-    df = df.drop(columns=columns_to_drop)
+    # Drop the columns that were only needed for cleaning
+    df = df.drop(columns=['ID number', 'Zip code']).reset_index(drop=True)
 
     # Return the cleaned DataFrame
     return df
 
-def drop_highly_correlated_features(df):
+def file_fingerprint(path, with_hash=True):
+    """
+    Compute the fingerprint of a file, used to check whether a cache is still up to date.
+
+    Parameters:
+    path (str): The path of the file.
+    with_hash (bool): Whether to include the SHA-256 hash of the file content.
+
+    Returns:
+    dict: The size, modification time and (optionally) hash of the file.
+    """
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    if with_hash:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+        fingerprint['sha256'] = sha256.hexdigest()
+
+    return fingerprint
+
+def save_frame(df, path, metadata=None):
+    """
+    Save a DataFrame to a columnar .npz file, together with optional metadata.
+
+    Numeric columns are stored as they are, and categorical columns as their codes and categories,
+    so the file can be loaded without pickle. The file is written atomically, so that a concurrent
+    reader never sees a partial file.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame to save.
+    path (str): The path of the .npz file.
+    metadata (dict): Optional JSON serializable metadata stored with the DataFrame.
+
+    Returns:
+    None
+    """
+    arrays = {}
+    columns = []
+
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            arrays[f'codes_{i}'] = values.cat.codes.to_numpy()
+            arrays[f'categories_{i}'] = values.cat.categories.to_numpy(dtype=str)
+            columns.append({'name': column, 'kind': 'category'})
+        else:
+            arrays[f'values_{i}'] = values.to_numpy()
+            columns.append({'name': column, 'kind': 'values'})
+
+    metadata = dict(metadata or {}, columns=columns)
+    arrays['metadata'] = np.array(json.dumps(metadata))
+
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temporary_path, path)
+
+def read_frame(archive, metadata):
+    """
+    Build the DataFrame stored in an open .npz archive written by save_frame.
+
+    Parameters:
+    archive (numpy.lib.npyio.NpzFile): The open archive.
+    metadata (dict): The metadata of the archive.
+
+    Returns:
+    pandas.DataFrame: The stored DataFrame.
+    """
+    data = {}
+    for i, column in enumerate(metadata['columns']):
+        if column['kind'] == 'category':
+            data[column['name']] = pd.Categorical.from_codes(archive[f'codes_{i}'], archive[f'categories_{i}'])
+        else:
+            data[column['name']] = archive[f'values_{i}']
+
+    return pd.DataFrame(data)
+
+def load_frame(path):
+    """
+    Load a DataFrame saved by save_frame.
+
+    Parameters:
+    path (str): The path of the .npz file.
+
+    Returns:
+    tuple: The DataFrame and its metadata.
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        metadata = json.loads(str(archive['metadata']))
+        return read_frame(archive, metadata), metadata
+
+def save_frame_cache(df, cache_path, source_path):
+    """
+    Save a DataFrame to a columnar .npz cache, together with the fingerprint of the file it was built from.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame to cache.
+    cache_path (str): The path of the cache file.
+    source_path (str): The path of the file the DataFrame was built from.
+
+    Returns:
+    None
+    """
+    save_frame(df, cache_path, {'version': CACHE_VERSION, 'source': file_fingerprint(source_path)})
+
+def load_frame_cache(cache_path, source_path):
+    """
+    Load a DataFrame from a columnar .npz cache, if the cache is up to date with the file it was built from.
+
+    The cache is up to date when the file has the same size and modification time as when the cache was written.
+    If only the modification time changed, the file content is hashed and compared instead.
+
+    Parameters:
+    cache_path (str): The path of the cache file.
+    source_path (str): The path of the file the DataFrame was built from.
+
+    Returns:
+    pandas.DataFrame: The cached DataFrame, or None if there is no up to date cache.
+    """
+    if not os.path.exists(cache_path):
+        return None
+
+    with np.load(cache_path, allow_pickle=False) as archive:
+        metadata = json.loads(str(archive['metadata']))
+        if metadata['version'] != CACHE_VERSION:
+            return None
+
+        # Compare the cheap part of the fingerprint first, and the hash only if it differs
+        cached = metadata['source']
+        current = file_fingerprint(source_path, with_hash=False)
+        if current['size'] != cached['size']:
+            return None
+        if current['mtime_ns'] != cached['mtime_ns'] and file_fingerprint(source_path)['sha256'] != cached['sha256']:
+            return None
+
+        return read_frame(archive, metadata)
+
+class RunningCorrelation:
+    """
+    Running statistics from which the pairwise correlation of numeric columns can be computed
+    without keeping the rows in memory.
+
+    For every pair of columns (i, j), the statistics hold the number of rows where both values are present,
+    and over these rows the sums of column i and the sums of the squares and products of the two columns.
+    Like pandas.DataFrame.corr, missing values are excluded pair by pair. The values are shifted by the first
+    value seen in each column before they are summed, which keeps the sums small and the result accurate.
+
+    Parameters:
+    columns (list): The names of the numeric columns.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        size = len(self.columns)
+
+        self.shift = None
+        self.count = np.zeros((size, size))
+        self.sums = np.zeros((size, size))
+        self.sums_of_squares = np.zeros((size, size))
+        self.sums_of_products = np.zeros((size, size))
+
+    def update(self, df):
+        """
+        Adds the rows of a DataFrame to the statistics.
+
+        Parameters:
+        df (pandas.DataFrame): The rows to add. It must contain all the columns of the statistics.
+
+        Returns:
+        None
+        """
+        X = df[self.columns].to_numpy(dtype=np.float64)
+        present = ~np.isnan(X)
+
+        if self.shift is None:
+            # Shift every column by its first value present in the rows (0 for a column without values)
+            first = np.argmax(present, axis=0)
+            self.shift = np.where(present.any(axis=0), X[first, np.arange(X.shape[1])], 0.0)
+
+        # Shifted values with zeros in place of the missing values, so they don't contribute to the sums
+        X = np.where(present, X - self.shift, 0.0)
+        mask = present.astype(np.float64)
+
+        self.count += mask.T @ mask
+        self.sums += X.T @ mask
+        self.sums_of_squares += (X * X).T @ mask
+        self.sums_of_products += X.T @ X
+
+    def correlation(self):
+        """
+        Computes the Pearson correlation matrix from the statistics.
+
+        Returns:
+        pandas.DataFrame: The correlation matrix, with NaN for the pairs that have fewer than two rows
+        or a constant column, like pandas.DataFrame.corr.
+        """
+        n = self.count
+        covariance = n * self.sums_of_products - self.sums * self.sums.T
+        variance = n * self.sums_of_squares - self.sums ** 2
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation = covariance / np.sqrt(variance * variance.T)
+
+        correlation[(n < 2) | (variance <= 0) | (variance.T <= 0)] = np.nan
+        np.fill_diagonal(correlation, np.where(np.diag(n) >= 2, 1.0, np.nan))
+
+        return pd.DataFrame(correlation, index=self.columns, columns=self.columns)
+
+    def columns_to_drop(self, threshold=0.95):
+        """
+        Identify the columns to drop because they are highly correlated with a previous column.
+
+        Parameters:
+        threshold (float): The absolute correlation above which a column is dropped.
+
+        Returns:
+        list: The names of the columns to drop.
+        """
+        return correlated_columns(self.correlation(), threshold)
+
+    def save(self, path):
+        """
+        Saves the statistics to a .npz file.
+
+        Parameters:
+        path (str): The path of the .npz file.
+
+        Returns:
+        None
+        """
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            np.savez(f, columns=np.array(self.columns, dtype=str),
+                     shift=self.shift if self.shift is not None else np.zeros(0),
+                     count=self.count, sums=self.sums, sums_of_squares=self.sums_of_squares,
+                     sums_of_products=self.sums_of_products)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads statistics saved by save.
+
+        Parameters:
+        path (str): The path of the .npz file.
+
+        Returns:
+        RunningCorrelation: The loaded statistics.
+        """
+        with np.load(path, allow_pickle=False) as archive:
+            statistics = cls(archive['columns'].tolist())
+            statistics.shift = archive['shift'] if archive['shift'].shape[0] else None
+            statistics.count = archive['count']
+            statistics.sums = archive['sums']
+            statistics.sums_of_squares = archive['sums_of_squares']
+            statistics.sums_of_products = archive['sums_of_products']
+
+        return statistics
+
+def correlated_columns(correlation_matrix, threshold=0.95):
+    """
+    Identify the columns whose absolute correlation with any previous column is greater than the threshold.
+
+    Only the upper triangle of the correlation matrix is used, so of two highly correlated columns
+    the first one is kept and the second one is returned.
+
+    Parameters:
+    correlation_matrix (pandas.DataFrame): The correlation matrix.
+    threshold (float): The absolute correlation above which a column is returned.
+
+    Returns:
+    list: The names of the columns to drop, in the order of the matrix.
+    """
+    correlation = np.abs(correlation_matrix.to_numpy())
+
+    # NaN correlations (constant columns, too few rows) never exceed the threshold
+    upper_triangle = np.triu(np.nan_to_num(correlation) > threshold, k=1)
+
+    return list(correlation_matrix.columns[upper_triangle.any(axis=0)])
+
+def drop_highly_correlated_features(df, statistics=None):
     """
     Remove features from a DataFrame that are highly correlated with other features.
 
@@ -84,30 +467,34 @@ def drop_highly_correlated_features(df):
 
     Parameters:
     df (pandas.DataFrame): The input DataFrame.
+    statistics (RunningCorrelation): Optional running statistics of the numeric columns, used instead of
+    computing the correlation from the DataFrame (e.g. when the rows were streamed in chunks, or when the
+    statistics are maintained incrementally as new rows arrive).
 
     Returns:
     pandas.DataFrame: A DataFrame with highly correlated features removed.
 
     """
-    # Create a new DataFrame containing only numeric columns from the input DataFrame
-    numeric_df = df.select_dtypes(include=[np.number])
-    
-    # Compute the correlation matrix of the numeric columns
-    correlation_matrix = numeric_df.corr().abs()
+    if statistics is not None:
+        # Read the decision straight from the running statistics
+        to_drop = statistics.columns_to_drop()
+    else:
+        # Create a new DataFrame containing only numeric columns from the input DataFrame
+        numeric_df = df.select_dtypes(include=[np.number])
 
-    # Compute a mask for the upper triangle of the correlation matrix
-    upper_triangle = correlation_matrix.where(np.triu(np.ones(correlation_matrix.shape), k=1).astype(np.bool_))
+        # Compute the correlation matrix of the numeric columns
+        correlation_matrix = numeric_df.corr()
 
-    # Identify columns whose correlation with any other column is greater than 0.95
-    to_drop = [column for column in upper_triangle.columns if any(upper_triangle[column] > 0.95)]
+        # Identify columns whose correlation with any previous column is greater than 0.95
+        to_drop = correlated_columns(correlation_matrix)
 
     # Drop these columns from the input DataFrame
-    df = df.drop(df[to_drop], axis=1)
+    df = df.drop(columns=to_drop)
 
     # Return the resulting DataFrame
     return df
 
-def preprocess_group_df(group_df, property_type):
+def preprocess_group_df(group_df, property_type, statistics=None):
     """
     Preprocesses the input DataFrame specific to the property type.
 
@@ -118,13 +505,15 @@ def preprocess_group_df(group_df, property_type):
     Parameters:
     group_df (pandas.DataFrame): The input DataFrame to be preprocessed.
     property_type (str): The type of property (e.g., 'apartment', 'house', etc.).
+    statistics (RunningCorrelation): Optional running statistics of the numeric columns of the group,
+    passed to drop_highly_correlated_features.
 
     Returns:
     pandas.DataFrame: The preprocessed DataFrame.
     """
 
     # Drop highly correlated features from the DataFrame
-    group_df = drop_highly_correlated_features(group_df)
+    group_df = drop_highly_correlated_features(group_df, statistics)
     
     # If the property type is 'apartment' and the DataFrame has a column 'Garden area', drop it
     if property_type == 'apartment':
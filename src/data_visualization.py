@@ -1,9 +1,7 @@
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import StandardScaler
-from sklearn.linear_model import LinearRegression
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+# scikit-learn, Matplotlib and seaborn are imported when a plot is drawn, so importing this module does not load them
 
 def plot_actual_vs_predicted(X, y, property_type, region):
     """
@@ -27,6 +25,11 @@ def plot_actual_vs_predicted(X, y, property_type, region):
     if 'Living area' not in X.columns:
         return
 
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from sklearn.linear_model import LinearRegression
+    from sklearn.preprocessing import StandardScaler
+
     # Scale the features
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(X)
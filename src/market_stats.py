@@ -0,0 +1,441 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+# pandas is only needed to build the cube from a DataFrame, and is imported by the functions that do it,
+# so the API can load and query the cube with NumPy only
+
+# Dimensions of the cube, in the order of the cell keys
+DIMENSIONS = ('region', 'type_of_property', 'subtype', 'bedrooms')
+
+# Label of a dimension that is aggregated over (e.g. all the regions)
+ALL = '*'
+
+# Bedroom buckets, the last one holding every property with at least 5 bedrooms
+BEDROOM_BUCKETS = ('0', '1', '2', '3', '4', '5+')
+
+# Label of the properties whose number of bedrooms or subtype is missing
+UNKNOWN = 'unknown'
+
+# Relative accuracy of the quantile sketches: a median is within 1% of the true median of the cell
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+# Ranges of values covered by the sketches, values outside of them are counted in the first or last bucket
+PRICE_RANGE = (1e3, 1e8)
+PRICE_PER_M2_RANGE = (10.0, 1e6)
+
+# Version of the file format, stored in the file so that files written by older versions are rejected
+FORMAT_VERSION = 1
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with logarithmic buckets (in the spirit of DDSketch).
+
+    A value v is counted in the bucket ceil(log(v / minimum) / log(gamma)), with gamma = (1 + a) / (1 - a)
+    for a relative accuracy a. Every value of a bucket is within a relative distance a of the estimate of the
+    bucket, so any quantile read from the bucket counts is within a relative distance a of a value of the data.
+    The sketch of a set of rows is the vector of its bucket counts: two sketches are merged by adding them,
+    which is what makes the cube both rollable (a cell is the sum of its children) and incrementally updatable.
+
+    Parameters:
+    value_range (tuple): The (minimum, maximum) of the values covered by the buckets.
+    relative_accuracy (float): The relative accuracy of the quantiles.
+    """
+
+    def __init__(self, value_range, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.minimum, self.maximum = (float(bound) for bound in value_range)
+        self.relative_accuracy = float(relative_accuracy)
+        self.gamma = (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+        self.n_buckets = int(np.ceil(np.log(self.maximum / self.minimum) / np.log(self.gamma))) + 1
+
+        # Estimate of every bucket, at the same relative distance of both of its bounds
+        upper_bounds = self.minimum * self.gamma ** np.arange(self.n_buckets)
+        self.estimates = 2 * upper_bounds / (self.gamma + 1)
+
+    def buckets(self, values):
+        """
+        Returns the bucket of every value.
+
+        Parameters:
+        values (numpy.ndarray): The positive values.
+
+        Returns:
+        numpy.ndarray: The bucket indices.
+        """
+        values = np.clip(np.asarray(values, dtype=np.float64), self.minimum, self.maximum)
+        buckets = np.ceil(np.log(values / self.minimum) / np.log(self.gamma) - 1e-9)
+
+        return np.clip(buckets, 0, self.n_buckets - 1).astype(np.intp)
+
+    def quantiles(self, counts, q):
+        """
+        Estimates a quantile of every sketch of a matrix of bucket counts.
+
+        Parameters:
+        counts (numpy.ndarray): The bucket counts, one sketch per row.
+        q (float): The quantile, between 0 and 1.
+
+        Returns:
+        numpy.ndarray: The quantile of every sketch, NaN for empty sketches.
+        """
+        cumulative = np.cumsum(counts, axis=1)
+        total = cumulative[:, -1] if cumulative.shape[1] else np.zeros(cumulative.shape[0])
+
+        # The bucket of the value of rank floor(q * (n - 1)), i.e. the lower median for q = 0.5
+        rank = np.floor(q * (total - 1))
+        buckets = np.argmax(cumulative > rank[:, None], axis=1)
+
+        return np.where(total > 0, self.estimates[buckets], np.nan)
+
+
+PRICE_SKETCH = QuantileSketch(PRICE_RANGE)
+PRICE_PER_M2_SKETCH = QuantileSketch(PRICE_PER_M2_RANGE)
+
+# Additive statistics held by every cell, with their dtype
+CELL_COLUMNS = {
+    'count': np.int64,
+    'price_sum': np.float64,
+    'price_sketch': np.uint32,
+    'area_count': np.int64,
+    'price_per_m2_sum': np.float64,
+    'price_per_m2_sketch': np.uint32,
+}
+
+
+class MarketStatsCube:
+    """
+    Materialized aggregate cube of the listing prices over (region, type_of_property, subtype, bedrooms).
+
+    Every cell holds, for the listings of a combination of dimension values, the number of listings with a
+    price, the sum of their prices and a quantile sketch of their prices, and the same statistics of the price
+    per m² over the listings that also have a living area. Besides the cells of every combination that occurs
+    in the data, the cube holds the roll-up cells where any subset of the dimensions is aggregated over (the
+    ALL label), so every query, e.g. the median price of the apartments of Antwerp whatever their subtype and
+    bedrooms, is answered from a single precomputed cell with a dictionary lookup.
+
+    All statistics are additive, so the cube of new listings is merged into an existing cube by adding the
+    cells with the same key, without going back to the listings already counted.
+
+    Parameters:
+    keys (list): The key of every cell, a tuple of one label per dimension of DIMENSIONS.
+    columns (dict): The statistics of CELL_COLUMNS, as arrays with one row per cell.
+    """
+
+    def __init__(self, keys, columns):
+        self.keys = [tuple(key) for key in keys]
+        self.columns = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in CELL_COLUMNS.items()}
+        self._prepare()
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Builds the cube of the listings of a DataFrame.
+
+        Listings without a price, property type or region are left out. The DataFrame must have the
+        'Subtype of property' column, e.g. as returned by load_and_clean_data(path, with_subtype=True).
+
+        Parameters:
+        df (pandas.DataFrame): The cleaned listings, as returned by load_and_clean_data.
+
+        Returns:
+        MarketStatsCube: The cube of the listings.
+        """
+        import pandas as pd
+
+        if 'Subtype of property' not in df.columns:
+            raise ValueError("The listings have no 'Subtype of property' column, "
+                             "load them with load_and_clean_data(path, with_subtype=True).")
+
+        price = df['Price of property in euro'].to_numpy(dtype=np.float64)
+        keep = (price > 0) & df['Type of property'].notna().to_numpy() & df['Region'].notna().to_numpy()
+        df = df[keep]
+        price = price[keep]
+
+        # Label every listing with its value of each dimension
+        bedrooms = df['Number of bedrooms'].to_numpy(dtype=np.float64)
+        labels = pd.DataFrame({
+            'region': df['Region'].astype(str).to_numpy(),
+            'type_of_property': df['Type of property'].astype(str).to_numpy(),
+            'subtype': df['Subtype of property'].astype(object).fillna(UNKNOWN).astype(str).str.strip().to_numpy(),
+            'bedrooms': bedroom_buckets(bedrooms),
+        })
+
+        # Aggregate the listings into the cells of the finest level, then roll these cells up
+        grouped = labels.groupby(list(DIMENSIONS), sort=True)
+        cells = grouped.ngroup().to_numpy()
+        keys = list(grouped.groups)
+        n_cells = len(keys)
+
+        living_area = df['Living area'].to_numpy(dtype=np.float64)
+        has_area = living_area > 0
+        price_per_m2 = price[has_area] / living_area[has_area]
+
+        price_sketch = np.zeros((n_cells, PRICE_SKETCH.n_buckets), dtype=np.uint32)
+        np.add.at(price_sketch, (cells, PRICE_SKETCH.buckets(price)), 1)
+        price_per_m2_sketch = np.zeros((n_cells, PRICE_PER_M2_SKETCH.n_buckets), dtype=np.uint32)
+        np.add.at(price_per_m2_sketch, (cells[has_area], PRICE_PER_M2_SKETCH.buckets(price_per_m2)), 1)
+
+        columns = {
+            'count': np.bincount(cells, minlength=n_cells),
+            'price_sum': np.bincount(cells, weights=price, minlength=n_cells),
+            'price_sketch': price_sketch,
+            'area_count': np.bincount(cells[has_area], minlength=n_cells),
+            'price_per_m2_sum': np.bincount(cells[has_area], weights=price_per_m2, minlength=n_cells),
+            'price_per_m2_sketch': price_per_m2_sketch,
+        }
+
+        return cls(*_aggregate(*_roll_up(keys, columns)))
+
+    def merge(self, other):
+        """
+        Returns the cube of the listings of this cube and of another one.
+
+        Parameters:
+        other (MarketStatsCube): The cube of other listings, e.g. of a new scrape.
+
+        Returns:
+        MarketStatsCube: The merged cube.
+        """
+        columns = {name: np.concatenate([self.columns[name], other.columns[name]]) for name in CELL_COLUMNS}
+
+        return type(self)(*_aggregate(self.keys + other.keys, columns))
+
+    def update(self, df):
+        """
+        Returns the cube with the listings of a DataFrame added to it.
+
+        The listings must not have been counted in the cube already: only pass the new rows.
+
+        Parameters:
+        df (pandas.DataFrame): The new listings, as returned by load_and_clean_data.
+
+        Returns:
+        MarketStatsCube: The updated cube.
+        """
+        return self.merge(type(self).from_frame(df))
+
+    def query(self, region=None, type_of_property=None, subtype=None, bedrooms=None):
+        """
+        Returns the statistics of the listings matching the given dimension values.
+
+        A dimension that is None is aggregated over. The number of bedrooms can be given as a number
+        or as one of the BEDROOM_BUCKETS labels.
+
+        Parameters:
+        region (str): The region.
+        type_of_property (str): The type of property ('house' or 'apartment').
+        subtype (str): The subtype of property (e.g. 'villa').
+        bedrooms (str or float): The number of bedrooms.
+
+        Returns:
+        dict: The number of listings, the mean and median price and the mean and median price per m²,
+        or None if no listing matches.
+        """
+        if bedrooms is not None and not isinstance(bedrooms, str):
+            bedrooms = bedroom_buckets([bedrooms])[0]
+
+        key = tuple(ALL if value is None else value for value in (region, type_of_property, subtype, bedrooms))
+        i = self._index.get(key)
+        if i is None:
+            return None
+
+        return self._stats[i]
+
+    def values(self):
+        """
+        Returns the values of every dimension found in the listings.
+
+        Returns:
+        dict: The sorted values of every dimension of DIMENSIONS.
+        """
+        return {
+            dimension: sorted({key[d] for key in self.keys} - {ALL})
+            for d, dimension in enumerate(DIMENSIONS)
+        }
+
+    def save(self, path, metadata=None):
+        """
+        Saves the cube to a .npz file, which is written atomically so that the API never reads a partial file.
+
+        Parameters:
+        path (str): The path of the .npz file.
+        metadata (dict): Optional JSON serializable metadata stored with the cube (e.g. the data it was built from).
+
+        Returns:
+        None
+        """
+        arrays = {name: values for name, values in self.columns.items()}
+        arrays['keys'] = np.array(self.keys, dtype=str).reshape(len(self.keys), len(DIMENSIONS))
+        arrays['metadata'] = np.array(json.dumps(dict(metadata or {}, version=FORMAT_VERSION)))
+
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a cube saved by save.
+
+        Parameters:
+        path (str): The path of the .npz file.
+
+        Returns:
+        tuple: The cube and its metadata.
+        """
+        with np.load(path, allow_pickle=False) as archive:
+            metadata = json.loads(str(archive['metadata']))
+            if metadata['version'] != FORMAT_VERSION:
+                raise ValueError(f"Unsupported market statistics format version {metadata['version']} in {path}.")
+
+            cube = cls(archive['keys'].tolist(), {name: archive[name] for name in CELL_COLUMNS})
+
+        return cube, metadata
+
+    def _prepare(self):
+        """
+        Precomputes the index of the cells and the statistics returned by query.
+
+        The means and medians of all cells are computed at once, so a query is a single dictionary lookup.
+
+        Returns:
+        None
+        """
+        self._index = {key: i for i, key in enumerate(self.keys)}
+
+        count = self.columns['count']
+        area_count = self.columns['area_count']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_price = self.columns['price_sum'] / count
+            mean_price_per_m2 = self.columns['price_per_m2_sum'] / area_count
+        median_price = PRICE_SKETCH.quantiles(self.columns['price_sketch'], 0.5)
+        median_price_per_m2 = PRICE_PER_M2_SKETCH.quantiles(self.columns['price_per_m2_sketch'], 0.5)
+
+        self._stats = [
+            {
+                'count': int(count[i]),
+                'mean_price': _finite(mean_price[i]),
+                'median_price': _finite(median_price[i]),
+                'count_with_living_area': int(area_count[i]),
+                'mean_price_per_m2': _finite(mean_price_per_m2[i]),
+                'median_price_per_m2': _finite(median_price_per_m2[i]),
+            }
+            for i in range(len(self.keys))
+        ]
+
+
+def bedroom_buckets(bedrooms):
+    """
+    Returns the bedroom bucket label of every number of bedrooms.
+
+    Parameters:
+    bedrooms (array-like): The numbers of bedrooms, NaN when missing.
+
+    Returns:
+    numpy.ndarray: The labels of BEDROOM_BUCKETS, or UNKNOWN for missing or negative values.
+    """
+    bedrooms = np.asarray(bedrooms, dtype=np.float64)
+    labels = np.array(BEDROOM_BUCKETS + (UNKNOWN,), dtype=object)
+
+    buckets = np.full(bedrooms.shape, len(BEDROOM_BUCKETS), dtype=np.intp)
+    known = np.isfinite(bedrooms) & (bedrooms >= 0)
+    buckets[known] = np.minimum(bedrooms[known], len(BEDROOM_BUCKETS) - 1).astype(np.intp)
+
+    return labels[buckets]
+
+
+def _roll_up(keys, columns):
+    """
+    Adds, for every cell, a copy of its statistics under each key where a subset of the dimensions is ALL.
+
+    Parameters:
+    keys (list): The keys of the cells.
+    columns (dict): The statistics of the cells.
+
+    Returns:
+    tuple: The keys and statistics of all the copies, to aggregate with _aggregate.
+    """
+    n_dimensions = len(DIMENSIONS)
+    masks = range(1 << n_dimensions)
+
+    rolled_keys = [
+        tuple(ALL if mask >> d & 1 else value for d, value in enumerate(key))
+        for mask in masks for key in keys
+    ]
+    rolled_columns = {name: np.concatenate([values] * len(masks)) for name, values in columns.items()}
+
+    return rolled_keys, rolled_columns
+
+
+def _aggregate(keys, columns):
+    """
+    Adds up the statistics of the cells that have the same key.
+
+    Parameters:
+    keys (list): The keys of the cells, with duplicates.
+    columns (dict): The statistics of the cells.
+
+    Returns:
+    tuple: The sorted distinct keys and their summed statistics.
+    """
+    unique_keys = sorted(set(keys))
+    positions = {key: i for i, key in enumerate(unique_keys)}
+    cells = np.fromiter((positions[key] for key in keys), dtype=np.intp, count=len(keys))
+
+    aggregated = {}
+    for name, values in columns.items():
+        summed = np.zeros((len(unique_keys),) + values.shape[1:], dtype=CELL_COLUMNS[name])
+        np.add.at(summed, cells, values.astype(CELL_COLUMNS[name], copy=False))
+        aggregated[name] = summed
+
+    return unique_keys, aggregated
+
+
+def _finite(value):
+    """
+    Converts a statistic to a float, or to None when it is not defined (empty cell).
+
+    Parameters:
+    value (float): The statistic.
+
+    Returns:
+    float: The statistic, or None.
+    """
+    return float(value) if np.isfinite(value) else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the market statistics cube served by the /stats endpoint.')
+    parser.add_argument('--data', default='./data/property_data.csv', help='path of the property data csv file')
+    parser.add_argument('--out', default='./models/market_stats.npz', help='path of the cube file')
+    parser.add_argument('--update', action='store_true',
+                        help='add the listings of --data (which must all be new) to the existing cube instead of rebuilding it')
+    args = parser.parse_args(argv)
+
+    from src.data_preprocessing import load_and_clean_data, file_fingerprint
+
+    start = time.perf_counter()
+    df = load_and_clean_data(args.data, with_subtype=True)
+    cube = MarketStatsCube.from_frame(df)
+    sources = []
+
+    if args.update:
+        previous, metadata = MarketStatsCube.load(args.out)
+        cube = previous.merge(cube)
+        sources = metadata.get('sources', [])
+
+    sources.append({'path': args.data, **file_fingerprint(args.data, with_hash=False)})
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    cube.save(args.out, {'sources': sources})
+
+    total = cube.query()
+    print(f"{'Updated' if args.update else 'Built'} {args.out}: {len(cube.keys)} cells, "
+          f"{total['count'] if total else 0} listings, in {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
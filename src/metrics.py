@@ -0,0 +1,369 @@
+import bisect
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values, in the format of a Prometheus histogram.
+
+    Parameters:
+    buckets (tuple): The sorted upper bounds of the buckets. A +Inf bucket is always added.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Adds a value to the histogram.
+
+        Parameters:
+        value (float): The observed value.
+
+        Returns:
+        None
+        """
+        # Find the first bucket the value fits in, the last one being +Inf
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name, labels):
+        """
+        Returns the histogram in the Prometheus text format.
+
+        Parameters:
+        name (str): The name of the metric.
+        labels (dict): The labels of the histogram.
+
+        Returns:
+        list: The lines of the _bucket, _sum and _count samples.
+        """
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{format_labels(dict(labels, le=le))} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {total!r}')
+        lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+        return lines
+
+
+def format_labels(labels):
+    """
+    Formats labels as a Prometheus label set, e.g. {stage="validation"}.
+
+    Parameters:
+    labels (dict): The label names and values.
+
+    Returns:
+    str: The label set, or an empty string if there are no labels.
+    """
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def process_memory():
+    """
+    Returns the memory used by the current process.
+
+    Returns:
+    dict: The resident set size, the part of it that is backed by files and can be shared with other
+    processes (e.g. a memory-mapped model store), both None where /proc is not available, and the peak
+    resident set size, in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = f.read().split()
+        resident = int(pages[1]) * os.sysconf('SC_PAGE_SIZE')
+        shared = int(pages[2]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        resident = shared = None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+
+    return {'resident': resident, 'shared': shared, 'peak_resident': peak}
+
+
+class Metrics:
+    """
+    Latency histograms and counters of the prediction API, rendered in the Prometheus text format.
+
+    The time spent in every stage of a request goes to a latency histogram per stage, the requests and
+    errors are counted per (type_of_property, region) segment, and the model loads of the model registry
+    are counted and timed per event when on_model_event is registered as a registry listener.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._model_loads = {}
+        self._model_evictions = 0
+        self._requests = Counter()
+        self._errors = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage):
+        """
+        Context manager that adds the time spent in its block to the histogram of a stage.
+
+        Parameters:
+        stage (str): The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        """
+        Adds the duration of a stage to its histogram.
+
+        Parameters:
+        stage (str): The name of the stage.
+        seconds (float): The time spent in the stage.
+
+        Returns:
+        None
+        """
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._stages.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    def count_request(self, segment, status):
+        """
+        Counts a request of a segment.
+
+        Parameters:
+        segment (tuple): The (type_of_property, region) segment of the request.
+        status (int): The HTTP status code of the response.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._requests[segment + (status,)] += 1
+
+    def count_error(self, segment, error):
+        """
+        Counts a failed prediction of a segment.
+
+        Parameters:
+        segment (tuple): The (type_of_property, region) segment of the request.
+        error (Exception): The exception raised by the prediction.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._errors[segment + (type(error).__name__,)] += 1
+
+    def on_model_event(self, event, property_type, region, seconds):
+        """
+        Model registry listener that counts and times the model loads and reloads, and counts the evictions
+        and removals.
+
+        Evictions and removals take no time, so they are counted separately instead of being observed in the
+        load time histogram, where they would pull its quantiles towards zero.
+
+        Returns:
+        None
+        """
+        if event in ('evict', 'remove'):
+            with self._lock:
+                self._model_evictions += 1
+            return
+
+        with self._lock:
+            histogram = self._model_loads.setdefault(event, Histogram())
+        histogram.observe(seconds)
+
+    def render(self, batching=None):
+        """
+        Returns all the metrics in the Prometheus text exposition format.
+
+        Parameters:
+        batching (dict): Optional statistics of the micro-batcher, as returned by MicroBatcher.stats.
+
+        Returns:
+        str: The metrics.
+        """
+        with self._lock:
+            stages = sorted(self._stages.items())
+            model_loads = sorted(self._model_loads.items())
+            model_evictions = self._model_evictions
+            requests = sorted(self._requests.items())
+            errors = sorted(self._errors.items())
+
+        lines = ['# HELP predict_stage_seconds Time spent in each stage of a prediction request.',
+                 '# TYPE predict_stage_seconds histogram']
+        for stage, histogram in stages:
+            lines += histogram.render('predict_stage_seconds', {'stage': stage})
+
+        lines += ['# HELP predict_requests_total Prediction requests per segment and status code.',
+                  '# TYPE predict_requests_total counter']
+        for (property_type, region, status), count in requests:
+            labels = {'type_of_property': property_type, 'region': region, 'status': status}
+            lines.append(f'predict_requests_total{format_labels(labels)} {count}')
+
+        lines += ['# HELP predict_errors_total Failed predictions per segment and exception type.',
+                  '# TYPE predict_errors_total counter']
+        for (property_type, region, error), count in errors:
+            labels = {'type_of_property': property_type, 'region': region, 'error': error}
+            lines.append(f'predict_errors_total{format_labels(labels)} {count}')
+
+        lines += ['# HELP model_load_seconds Time spent loading models, per registry event (load or reload).',
+                  '# TYPE model_load_seconds histogram']
+        for event, histogram in model_loads:
+            lines += histogram.render('model_load_seconds', {'event': event})
+
+        lines += ['# HELP model_evictions_total Models removed from the registry.',
+                  '# TYPE model_evictions_total counter',
+                  f'model_evictions_total {model_evictions}']
+
+        if batching is not None:
+            lines += ['# HELP predict_batches_total Micro-batches of prediction requests scored with one model call.',
+                      '# TYPE predict_batches_total counter',
+                      f"predict_batches_total {batching['batches']}",
+                      '# HELP predict_batched_rows_total Prediction requests scored in micro-batches.',
+                      '# TYPE predict_batched_rows_total counter',
+                      f"predict_batched_rows_total {batching['rows']}"]
+
+        memory = process_memory()
+        if memory['resident'] is not None:
+            lines += ['# HELP process_resident_memory_bytes Resident memory size in bytes.',
+                      '# TYPE process_resident_memory_bytes gauge',
+                      f"process_resident_memory_bytes {memory['resident']}",
+                      '# HELP process_shared_memory_bytes Resident memory backed by files that can be shared with other processes.',
+                      '# TYPE process_shared_memory_bytes gauge',
+                      f"process_shared_memory_bytes {memory['shared']}"]
+        lines += ['# HELP process_peak_resident_memory_bytes Peak resident memory size in bytes.',
+                  '# TYPE process_peak_resident_memory_bytes gauge',
+                  f"process_peak_resident_memory_bytes {memory['peak_resident']}"]
+
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that periodically samples the call stacks of all the threads of the process.
+
+    A background thread records the stack of every other thread every interval seconds, so the overhead
+    does not depend on the number of function calls, and the profiler can be started and stopped while the
+    API is serving. The samples are aggregated as collapsed stacks ('outer;inner;innermost' and a count),
+    the input format of flame graph tools.
+
+    Parameters:
+    interval (float): The number of seconds between two samples.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        """
+        Whether the profiler is sampling.
+        """
+        return self._thread is not None
+
+    def start(self):
+        """
+        Starts sampling, after clearing the previous samples. Does nothing if the profiler is already running.
+
+        Returns:
+        None
+        """
+        if self._thread is not None:
+            return
+
+        self.samples = Counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling. The samples are kept until the next start.
+
+        Returns:
+        None
+        """
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def report(self, limit=50):
+        """
+        Returns the most frequent stacks.
+
+        Parameters:
+        limit (int): The maximum number of stacks returned.
+
+        Returns:
+        dict: The number of samples taken, and the most frequent collapsed stacks with their sample count.
+        """
+        samples = self.samples.copy()
+
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'samples': sum(samples.values()),
+            'stacks': [{'stack': stack, 'count': count} for stack, count in samples.most_common(limit)],
+        }
+
+    def _run(self):
+        """
+        Samples the stacks of the other threads until stop is called.
+
+        Returns:
+        None
+        """
+        own_id = threading.get_ident()
+
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = ';'.join(f'{entry.name} ({os.path.basename(entry.filename)})'
+                                 for entry in traceback.extract_stack(frame))
+                self.samples[stack] += 1
@@ -0,0 +1,123 @@
+import asyncio
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-row predictions with the same key into one vectorized model call.
+
+    The key identifies what scores the rows, e.g. the model of their segment. The first row submitted with
+    a key opens a batch that stays open for at most max_delay seconds, or until it holds max_rows rows.
+    The batch is then scored by a single call to predict, run in the default thread pool executor so the
+    event loop is never blocked, and every awaiting request gets its own prediction back. A request
+    therefore waits at most max_delay seconds longer than it would alone.
+
+    Parameters:
+    predict (callable): Function called as predict(key, features), with the key of the batch and a 2D
+    feature matrix, that returns one prediction per row.
+    max_delay (float): The maximum number of seconds a batch stays open.
+    max_rows (int): The number of rows after which a batch is scored without waiting any longer.
+    """
+
+    def __init__(self, predict, max_delay=0.002, max_rows=64):
+        self.predict = predict
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+
+        # Open batches and the timers that close them, per key
+        self._pending = {}
+        self._timers = {}
+
+        # Running batches, kept referenced until they are done
+        self._tasks = set()
+
+        self.batches = 0
+        self.rows = 0
+
+    async def submit(self, key, features):
+        """
+        Adds a row to the open batch of its key and waits for its prediction.
+
+        Parameters:
+        key (object): The key of the row, passed to predict with the batch. It must be hashable.
+        features (numpy.ndarray): The features of the row, as a 1D array.
+
+        Returns:
+        float: The prediction for the row.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        batch = self._pending.setdefault(key, [])
+        batch.append((features, future))
+
+        if len(batch) >= self.max_rows:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.max_delay, self._flush, key)
+
+        return await future
+
+    def stats(self):
+        """
+        Returns the number of batches and rows scored so far.
+
+        Returns:
+        dict: The number of batches, the number of rows and the mean number of rows per batch.
+        """
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'mean_batch_size': self.rows / self.batches if self.batches else None,
+        }
+
+    def _flush(self, key):
+        """
+        Closes the open batch of a key and starts scoring it.
+
+        Parameters:
+        key (object): The key of the batch.
+
+        Returns:
+        None
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._score(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _score(self, key, batch):
+        """
+        Scores a batch with a single call to predict and resolves the future of every row.
+
+        Parameters:
+        key (object): The key of the batch.
+        batch (list): The (features, future) pairs of the batch.
+
+        Returns:
+        None
+        """
+        self.batches += 1
+        self.rows += len(batch)
+
+        # Any failure, including rows that cannot be stacked, is passed on to every request of the batch
+        try:
+            features = np.stack([row for row, _ in batch])
+            predictions = await asyncio.get_running_loop().run_in_executor(None, self.predict, key, features)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), prediction in zip(batch, predictions):
+            # The request may have been cancelled while the batch was scored
+            if not future.done():
+                future.set_result(prediction)
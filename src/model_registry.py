@@ -0,0 +1,433 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from src.compiled_model import load_compiled_model
+from src.model_store import ModelStore
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+    In-memory registry of the per-segment price models stored in the models directory.
+
+    Models are keyed by (type_of_property, region) and are loaded from files named
+    '{type_of_property}_{region}_model.npz' (compiled models, evaluated with NumPy only) or
+    '{type_of_property}_{region}_model.pickle' (pickled sklearn/XGBoost models). When both exist, the
+    compiled model is used unless prefer_compiled is False. They can either be preloaded all at once at
+    startup or loaded lazily on first use, in which case an optional LRU bound limits how many models are
+    kept in memory. A background thread, started with start_refresher, periodically checks the version of every
+    model file and atomically swaps in the new model when a file changes, so a model can be replaced on disk
+    without restarting the API, and get never touches the disk for a model that is already loaded.
+
+    When a store_path is given, the models are served from that model store file instead (see src.model_store):
+    the store is memory-mapped read-only, so several API workers share a single copy of the models, and a new
+    model set published by renaming a new store over it is picked up like a changed model file.
+
+    Parameters:
+    models_dir (str): The directory that contains the model files.
+    max_size (int): The maximum number of models kept in memory. None means no limit.
+    check_interval (float): The number of seconds between two checks of the model files for changes by the refresher.
+    prefer_compiled (bool): Whether to load the compiled model rather than the pickled one when both exist.
+    store_path (str): Optional path of a model store file to serve the models from.
+    """
+
+    def __init__(self, models_dir='./models', max_size=None, check_interval=5.0, prefer_compiled=True, store_path=None):
+        self.models_dir = models_dir
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.prefer_compiled = prefer_compiled
+        self.store_path = store_path
+
+        # Model store the models are currently served from, when store_path is set
+        self._store = None
+
+        # Loaded models, ordered from least to most recently used
+        self._models = OrderedDict()
+
+        # Path and version, the (inode, modification time) of the file, each model was last read from. They are
+        # kept when the model is evicted, so that refresh also notices the files of evicted models that change
+        self._sources = {}
+
+        # Per-segment statistics exposed through stats()
+        self._load_times = {}
+        self._load_counts = {}
+        self._hits = {}
+        self._misses = {}
+
+        # Functions called when a model is loaded, reloaded, evicted or removed
+        self._listeners = []
+
+        self._lock = threading.RLock()
+
+        # Background thread that calls refresh every check_interval seconds, and the event that stops it
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+
+    def add_listener(self, listener):
+        """
+        Registers a function to call whenever a model is loaded, reloaded, evicted or removed.
+
+        The function is called as listener(event, property_type, region, seconds), where event is one of:
+        - 'load': a model was read for the first time, or again from the same file after it was evicted.
+        - 'reload': a model was read from a file that changed since the model was last read.
+        - 'evict': a model was dropped from memory, by the LRU bound or by evict. Its file did not change.
+        - 'remove': the model file was removed, or the new model store has no model for the segment.
+        seconds is the time it took to load the model, and None for 'evict' and 'remove'.
+
+        Parameters:
+        listener (callable): The function to call.
+
+        Returns:
+        None
+        """
+        self._listeners.append(listener)
+
+    def model_path(self, property_type, region):
+        """
+        Returns the path of the model file for the given property type and region.
+
+        Parameters:
+        property_type (str): The type of property ('house' or 'apartment').
+        region (str): The region of the property.
+
+        Returns:
+        str: The path of the model store if there is one, else the path of the compiled model file if it exists
+        and is preferred, of the pickled model file otherwise.
+        """
+        if self.store_path is not None:
+            return self.store_path
+
+        compiled_path = os.path.join(self.models_dir, f'{property_type}_{region}_model.npz')
+        pickle_path = os.path.join(self.models_dir, f'{property_type}_{region}_model.pickle')
+
+        if self.prefer_compiled and os.path.exists(compiled_path):
+            return compiled_path
+        if os.path.exists(pickle_path) or not os.path.exists(compiled_path):
+            return pickle_path
+        return compiled_path
+
+    def available_segments(self):
+        """
+        Lists the (property_type, region) segments that have a model file in the models directory.
+
+        Returns:
+        list: A sorted list of (property_type, region) tuples.
+        """
+        if self.store_path is not None:
+            return self._open_store().segments() if os.path.exists(self.store_path) else []
+
+        segments = set()
+
+        for filename in os.listdir(self.models_dir):
+            for suffix in ('_model.npz', '_model.pickle'):
+                if not filename.endswith(suffix):
+                    continue
+
+                # The property type never contains an underscore, so the first one separates it from the region
+                property_type, _, region = filename[:-len(suffix)].partition('_')
+                if region:
+                    segments.add((property_type, region))
+
+        return sorted(segments)
+
+    def load_all(self):
+        """
+        Loads every model found in the models directory into memory.
+
+        When the registry has an LRU bound, only the last max_size models stay in memory.
+
+        Returns:
+        None
+        """
+        for property_type, region in self.available_segments():
+            self._load(property_type, region)
+
+    def get(self, property_type, region):
+        """
+        Returns the model for the given property type and region.
+
+        The model is served from memory when it is already loaded and read from disk otherwise. Changed model
+        files are picked up by the background refresher, not by this method.
+
+        Parameters:
+        property_type (str): The type of property ('house' or 'apartment').
+        region (str): The region of the property.
+
+        Returns:
+        object: The model, or None if there is no model file for this segment.
+        """
+        model = self.peek(property_type, region)
+        if model is not None:
+            return model
+
+        key = (property_type, region)
+        with self._lock:
+            self._misses[key] = self._misses.get(key, 0) + 1
+
+        if not os.path.exists(self.model_path(property_type, region)):
+            return None
+
+        return self._load(property_type, region)
+
+    def peek(self, property_type, region):
+        """
+        Returns the model for the given property type and region if it is already loaded, without touching the disk.
+
+        This lets an async caller serve the loaded models inline, and only hand a miss, which reads the model
+        from disk with get, over to a thread.
+
+        Parameters:
+        property_type (str): The type of property ('house' or 'apartment').
+        region (str): The region of the property.
+
+        Returns:
+        object: The model, or None if it is not loaded.
+        """
+        key = (property_type, region)
+
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self._hits[key] = self._hits.get(key, 0) + 1
+
+            return model
+
+    def refresh(self):
+        """
+        Reloads every loaded model whose file changed on disk, and forgets models whose file was removed.
+
+        The file of a model evicted from memory is checked as well: when it changed, the segment is removed, so
+        that the listeners drop what they derived from the previous model, and the new file is read on next use.
+
+        Returns:
+        list: The (property_type, region) segments that were reloaded or removed.
+        """
+        changed = []
+
+        with self._lock:
+            sources = list(self._sources.items())
+
+        for key, (path, version) in sources:
+            current_path = self.model_path(*key)
+            try:
+                current_version = file_version(current_path)
+            except FileNotFoundError:
+                self._remove(*key)
+                changed.append(key)
+                continue
+
+            # A file renamed over the previous one has a new inode even if its modification time was preserved
+            if (current_path, current_version) != (path, version):
+                with self._lock:
+                    loaded = key in self._models
+
+                # A new model store may no longer have a model for this segment
+                if not loaded or self._load(*key) is None:
+                    self._remove(*key)
+                changed.append(key)
+
+        return changed
+
+    def start_refresher(self):
+        """
+        Starts the background thread that calls refresh every check_interval seconds.
+
+        Returns:
+        None
+        """
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+
+        self._stop_refresher.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name='model-registry-refresher', daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        """
+        Stops the background thread started by start_refresher and waits for it to finish.
+
+        Returns:
+        None
+        """
+        self._stop_refresher.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+    def _refresh_loop(self):
+        """
+        Calls refresh every check_interval seconds until stop_refresher is called.
+
+        A failed check is logged and retried at the next interval, so the thread never dies.
+
+        Returns:
+        None
+        """
+        while not self._stop_refresher.wait(self.check_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to check the models for changes")
+
+    def evict(self, property_type, region):
+        """
+        Removes the model for the given property type and region from memory. It is read again on next use.
+
+        Parameters:
+        property_type (str): The type of property ('house' or 'apartment').
+        region (str): The region of the property.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._models.pop((property_type, region), None)
+
+        self._notify('evict', property_type, region, None)
+
+    def stats(self):
+        """
+        Returns the load and usage statistics of every segment the registry has seen.
+
+        Returns:
+        dict: A dictionary keyed by '{property_type}_{region}' with, for each segment, whether the model
+        is loaded, how often and how long it took to load, and its number of cache hits and misses.
+        """
+        with self._lock:
+            keys = set(self._load_times) | set(self._hits) | set(self._misses)
+
+            return {
+                f'{property_type}_{region}': {
+                    'loaded': (property_type, region) in self._models,
+                    'load_count': self._load_counts.get((property_type, region), 0),
+                    'last_load_seconds': self._load_times.get((property_type, region)),
+                    'hits': self._hits.get((property_type, region), 0),
+                    'misses': self._misses.get((property_type, region), 0),
+                }
+                for property_type, region in sorted(keys)
+            }
+
+    def _load(self, property_type, region):
+        """
+        Reads the model for the given segment from disk and stores it in the registry.
+
+        The model is fully loaded before it replaces the previous one, so concurrent readers
+        always see either the old or the new model.
+
+        Parameters:
+        property_type (str): The type of property ('house' or 'apartment').
+        region (str): The region of the property.
+
+        Returns:
+        object: The loaded model, or None if the model store has no model for this segment.
+        """
+        key = (property_type, region)
+        path = self.model_path(property_type, region)
+
+        start = time.perf_counter()
+        if self.store_path is not None:
+            store = self._open_store()
+            version = store.version
+            model = store.get(property_type, region)
+            if model is None:
+                return None
+        elif path.endswith('.npz'):
+            version = file_version(path)
+            model = load_compiled_model(path)
+        else:
+            version = file_version(path)
+            with open(path, 'rb') as f:
+                model = pickle.load(f)
+        elapsed = time.perf_counter() - start
+
+        evicted = []
+        with self._lock:
+            # A model evicted from memory whose file changed before it was read again is also a reload
+            changed = self._sources.get(key, (path, version)) != (path, version)
+            event = 'reload' if key in self._models or changed else 'load'
+            self._models[key] = model
+            self._models.move_to_end(key)
+            self._sources[key] = (path, version)
+            self._load_times[key] = elapsed
+            self._load_counts[key] = self._load_counts.get(key, 0) + 1
+
+            # Drop the least recently used models once the LRU bound is exceeded
+            if self.max_size is not None:
+                while len(self._models) > self.max_size:
+                    evicted_key, _ = self._models.popitem(last=False)
+                    evicted.append(evicted_key)
+
+        self._notify(event, property_type, region, elapsed)
+        for evicted_key in evicted:
+            self._notify('evict', *evicted_key, None)
+
+        return model
+
+    def _remove(self, property_type, region):
+        """
+        Forgets the model for the given segment after its file was removed or replaced.
+
+        Parameters:
+        property_type (str): The type of property ('house' or 'apartment').
+        region (str): The region of the property.
+
+        Returns:
+        None
+        """
+        key = (property_type, region)
+
+        with self._lock:
+            self._models.pop(key, None)
+            self._sources.pop(key, None)
+
+        self._notify('remove', property_type, region, None)
+
+    def _open_store(self):
+        """
+        Returns the model store, mapping the store file again if it was replaced since it was opened.
+
+        Returns:
+        ModelStore: The model store.
+        """
+        version = file_version(self.store_path)
+
+        with self._lock:
+            if self._store is None or self._store.version != version:
+                self._store = ModelStore(self.store_path)
+            return self._store
+
+    def _notify(self, event, property_type, region, seconds):
+        """
+        Calls every registered listener with a model event.
+
+        Parameters:
+        event (str): 'load', 'reload', 'evict' or 'remove'.
+        property_type (str): The type of property ('house' or 'apartment').
+        region (str): The region of the property.
+        seconds (float): The time it took to load the model, or None.
+
+        Returns:
+        None
+        """
+        for listener in self._listeners:
+            listener(event, property_type, region, seconds)
+
+
+def file_version(path):
+    """
+    Returns the version of a file, which changes whenever the file is modified or replaced.
+
+    Parameters:
+    path (str): The path of the file.
+
+    Returns:
+    tuple: The inode and the modification time (in nanoseconds) of the file.
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
@@ -0,0 +1,323 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import KFold
+from xgboost import XGBRegressor
+
+from src.data_preprocessing import load_and_clean_data, filter_data
+from src.model_training import save_segment_model, split_data
+from src.streaming import list_partitions, load_partition
+from src.train import load_manifest, prepare_segment, record_training, row_hashes, save_manifest
+
+# XGBoost hyperparameters searched for every segment
+PARAM_GRID = {
+    'max_depth': [3, 4, 6, 8],
+    'learning_rate': [0.03, 0.1, 0.3],
+}
+
+# Maximum number of boosting rounds (n_estimators) of each successive halving rung
+N_ESTIMATORS_RUNGS = [100, 300, 900]
+
+# Share of the training rows of a fold set aside to decide when XGBoost stops boosting
+VALIDATION_FRACTION = 0.2
+
+
+def fit_fold(X, y, train_index, test_index, params, n_estimators, early_stopping_rounds, n_jobs):
+    """
+    Fits a model on the training rows of a fold and evaluates it on the held out rows.
+
+    XGBoost models stop boosting when the error on a validation split of the training rows (VALIDATION_FRACTION
+    of them) has not improved for early_stopping_rounds rounds, so weak candidates don't use their whole
+    n_estimators budget. The held out rows are only used to score the model, so they play no part in its fit.
+
+    Parameters:
+    X (numpy.ndarray): The features of the segment.
+    y (numpy.ndarray): The target of the segment.
+    train_index (numpy.ndarray): The indices of the training rows of the fold.
+    test_index (numpy.ndarray): The indices of the held out rows of the fold.
+    params (dict): The XGBoost hyperparameters, or None for a Linear Regression model.
+    n_estimators (int): The maximum number of boosting rounds.
+    early_stopping_rounds (int): The number of rounds without improvement after which boosting stops.
+    n_jobs (int): The number of threads used by XGBoost.
+
+    Returns:
+    tuple: The root mean squared error on the held out rows and the number of boosting rounds used
+    (None for a Linear Regression model).
+    """
+    if params is None:
+        model = LinearRegression()
+        model.fit(X[train_index], y[train_index])
+        rounds = None
+    else:
+        shuffled = np.random.default_rng(42).permutation(train_index)
+        n_validation = max(1, int(len(shuffled) * VALIDATION_FRACTION))
+        validation_index, fit_index = shuffled[:n_validation], shuffled[n_validation:]
+
+        model = XGBRegressor(objective='reg:squarederror', n_estimators=n_estimators,
+                             early_stopping_rounds=early_stopping_rounds, n_jobs=n_jobs, **params)
+        model.fit(X[fit_index], y[fit_index], eval_set=[(X[validation_index], y[validation_index])], verbose=False)
+        rounds = model.best_iteration + 1
+
+    predictions = model.predict(X[test_index])
+    rmse = float(np.sqrt(np.mean((y[test_index] - predictions) ** 2)))
+
+    return rmse, rounds
+
+
+def refit_segment(X, y, features, selection, property_type, region, models_dir, n_jobs):
+    """
+    Fits the selected model of a segment and saves it.
+
+    The rows are split and scaled with split_data, like in src.train, so the saved model takes the same
+    standardized features as the models trained by src.train, and it is evaluated on the test split.
+
+    Parameters:
+    X (numpy.ndarray): The features of the segment.
+    y (numpy.ndarray): The target of the segment.
+    features (list): The names of the features, in the order of the columns of X.
+    selection (dict): The selection of the segment, as returned by search_segments.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+    models_dir (str): The directory the model is saved to.
+    n_jobs (int): The number of threads used by XGBoost.
+
+    Returns:
+    dict: The features and scaler of the model, and its kind and test metrics, for the training manifest.
+    """
+    X_train, X_test, y_train, y_test, scaler = split_data(X, y, return_scaler=True)
+
+    if selection['model'] == 'linear_regression':
+        model = LinearRegression()
+    else:
+        model = XGBRegressor(objective='reg:squarederror', n_jobs=n_jobs, **selection['params'])
+
+    model.fit(X_train, y_train)
+    save_segment_model(model, property_type, region, models_dir, X_test)
+
+    predictions = model.predict(X_test)
+    return {
+        'features': features,
+        'scaler': {'mean': scaler.mean_.tolist(), 'scale': scaler.scale_.tolist()},
+        'model': selection['model'],
+        'mse_test': float(mean_squared_error(y_test, predictions)),
+        'r2_test': float(r2_score(y_test, predictions)),
+    }
+
+
+def search_segments(segments, folds=5, workers=None, eta=3, early_stopping_rounds=20):
+    """
+    Selects the best model of every segment with k-fold cross-validation and successive halving.
+
+    Every XGBoost candidate of PARAM_GRID is first cross-validated with the smallest n_estimators budget of
+    N_ESTIMATORS_RUNGS. Only the best 1/eta of the candidates move on to the next, larger budget, and so on.
+    Boosting also stops early within each fold. A candidate whose folds all stopped well before the budget
+    would not change with a larger one, so its result is carried over without training it again. The folds of
+    all candidates of all segments are spread over a process pool. A Linear Regression model is cross-validated
+    on the same folds, and the model with the lowest mean root mean squared error (RMSE) over the folds is selected.
+
+    Parameters:
+    segments (dict): The (X, y) NumPy arrays of every (property_type, region) segment.
+    folds (int): The number of cross-validation folds.
+    workers (int): The number of processes. None uses one process per core.
+    eta (int): The factor by which the number of candidates is divided at each rung.
+    early_stopping_rounds (int): The number of rounds without improvement after which boosting stops.
+
+    Returns:
+    dict: For every segment, the selected model ('linear_regression' or 'xgboost'), its hyperparameters
+    (with n_estimators set to the mean number of rounds used over the folds) and the cross-validated RMSE
+    of the Linear Regression model and of every XGBoost candidate at its last rung.
+    """
+    cpu_count = os.cpu_count() or 1
+    workers = workers or cpu_count
+    n_jobs = max(1, cpu_count // workers)
+
+    candidates = [dict(zip(PARAM_GRID, values)) for values in itertools.product(*PARAM_GRID.values())]
+
+    splits = {
+        segment: list(KFold(n_splits=min(folds, len(y)), shuffle=True, random_state=42).split(X))
+        for segment, (X, y) in segments.items()
+    }
+
+    # Candidates still in the race, and the last cross-validation result of every candidate, per segment
+    alive = {segment: list(range(len(candidates))) for segment in segments}
+    results = {segment: {} for segment in segments}
+    linear_rmse = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Cross-validate the Linear Regression models alongside the first rung
+        linear_futures = {
+            segment: [executor.submit(fit_fold, X, y, train_index, test_index, None, None, None, n_jobs)
+                      for train_index, test_index in splits[segment]]
+            for segment, (X, y) in segments.items()
+        }
+
+        for rung, n_estimators in enumerate(N_ESTIMATORS_RUNGS):
+            futures = {}
+            for segment, (X, y) in segments.items():
+                for candidate in alive[segment]:
+                    previous = results[segment].get(candidate)
+                    if previous is not None and previous['converged']:
+                        continue
+
+                    futures[(segment, candidate)] = [
+                        executor.submit(fit_fold, X, y, train_index, test_index, candidates[candidate],
+                                        n_estimators, early_stopping_rounds, n_jobs)
+                        for train_index, test_index in splits[segment]
+                    ]
+
+            for (segment, candidate), fold_futures in futures.items():
+                fold_results = [future.result() for future in fold_futures]
+                rounds = [fold_rounds for _, fold_rounds in fold_results]
+                results[segment][candidate] = {
+                    'rmse': float(np.mean([rmse for rmse, _ in fold_results])),
+                    'rounds': int(round(np.mean(rounds))),
+                    'n_estimators': n_estimators,
+                    'converged': max(rounds) + early_stopping_rounds < n_estimators,
+                }
+
+            # Keep the best 1/eta of the candidates for the next rung
+            if rung < len(N_ESTIMATORS_RUNGS) - 1:
+                for segment in segments:
+                    ranked = sorted(alive[segment], key=lambda candidate: results[segment][candidate]['rmse'])
+                    alive[segment] = ranked[:max(1, math.ceil(len(ranked) / eta))]
+
+        for segment, fold_futures in linear_futures.items():
+            linear_rmse[segment] = float(np.mean([future.result()[0] for future in fold_futures]))
+
+    selections = {}
+    for segment in segments:
+        best = min(alive[segment], key=lambda candidate: results[segment][candidate]['rmse'])
+        best_result = results[segment][best]
+
+        selection = {
+            'linear_regression_rmse': linear_rmse[segment],
+            'xgboost_rmse': best_result['rmse'],
+            'candidates': [dict(candidates[candidate], **result) for candidate, result in results[segment].items()],
+        }
+
+        if linear_rmse[segment] <= best_result['rmse']:
+            selection.update(model='linear_regression', params={}, rmse=linear_rmse[segment])
+        else:
+            params = dict(candidates[best], n_estimators=best_result['rounds'])
+            selection.update(model='xgboost', params=params, rmse=best_result['rmse'])
+
+        selections[segment] = selection
+
+    return selections
+
+
+def select_models(data_path, models_dir='./models', folds=5, workers=None, partitions_dir=None):
+    """
+    Selects, refits and saves the best model of every segment.
+
+    The training manifest of the models directory is updated for every saved model, like after src.train,
+    so an incremental training compares the segment with the rows and scaler of this model.
+
+    Parameters:
+    data_path (str): The path of the property data csv file.
+    models_dir (str): The directory the selected models are saved to.
+    folds (int): The number of cross-validation folds.
+    workers (int): The number of processes. None uses one process per core.
+    partitions_dir (str): Optional directory of partitions written by src.streaming, used instead of data_path.
+
+    Returns:
+    dict: The selection of every segment, as returned by search_segments.
+    """
+    segments = {}
+    hashes = {}
+    if partitions_dir is not None:
+        for property_type, region in list_partitions(partitions_dir):
+            group_df, statistics = load_partition(partitions_dir, property_type, region)
+            segments[(property_type, region)] = prepare_segment(group_df, property_type, region, statistics)
+            hashes[(property_type, region)] = row_hashes(filter_data(group_df, property_type, region))
+    else:
+        df = load_and_clean_data(data_path)
+        for (property_type, region), group_df in df.groupby(['Type of property', 'Region'], observed=True):
+            segments[(property_type, region)] = prepare_segment(group_df, property_type, region)
+            hashes[(property_type, region)] = row_hashes(filter_data(group_df, property_type, region))
+
+    features = {segment: list(X.columns) for segment, (X, _) in segments.items()}
+    segments = {
+        segment: (X.to_numpy(dtype=np.float64), y.to_numpy(dtype=np.float64))
+        for segment, (X, y) in segments.items()
+    }
+
+    selections = search_segments(segments, folds, workers)
+
+    os.makedirs(models_dir, exist_ok=True)
+
+    cpu_count = os.cpu_count() or 1
+    workers = workers or cpu_count
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            segment: executor.submit(refit_segment, X, y, features[segment], selections[segment], *segment,
+                                     models_dir, max(1, cpu_count // workers))
+            for segment, (X, y) in segments.items()
+        }
+        refits = {segment: future.result() for segment, future in futures.items()}
+
+    # Record the saved models in the training manifest, with the rows they were trained on
+    manifest = load_manifest(models_dir)
+    summaries = []
+    for (property_type, region), refit in refits.items():
+        entry = dict(manifest.get(f'{property_type}_{region}', {}), **refit)
+        entry.pop('drift', None)
+        record_training(entry, hashes[(property_type, region)], refit['model'], refit, models_dir, property_type, region)
+        entry.update(action='model_selection', reason=f'selected by {folds}-fold cross-validation')
+        summaries.append({'property_type': property_type, 'region': region, 'manifest': entry})
+    save_manifest(models_dir, summaries)
+
+    # Keep a report of the search next to the models, written atomically like the models
+    report = {f'{property_type}_{region}': selection for (property_type, region), selection in selections.items()}
+    path = os.path.join(models_dir, 'model_selection.json')
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(temporary_path, path)
+
+    return selections
+
+
+def main(argv=None):
+    """
+    Command line entry point that selects the model of every segment: python -m src.model_selection
+
+    Parameters:
+    argv (list): The command line arguments. None uses sys.argv.
+
+    Returns:
+    int: The exit code.
+    """
+    parser = argparse.ArgumentParser(description='Select the best model of every (property type, region) segment.')
+    parser.add_argument('--data', default='./data/property_data.csv', help='path of the property data csv file')
+    parser.add_argument('--partitions', default=None, help='directory of partitions written by src.streaming, used instead of --data')
+    parser.add_argument('--models-dir', default='./models', help='directory the selected models are saved to')
+    parser.add_argument('--folds', type=int, default=5, help='number of cross-validation folds')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    selections = select_models(args.data, args.models_dir, args.folds, args.workers, args.partitions)
+
+    print(f"{'Segment':<32} {'LR RMSE':>10} {'XGB RMSE':>10} {'Saved':>6}  XGBoost parameters")
+    for (property_type, region), selection in sorted(selections.items()):
+        params = ', '.join(f'{name}={value}' for name, value in selection['params'].items())
+        saved = 'LR' if selection['model'] == 'linear_regression' else 'XGB'
+        print(f"{property_type + ' / ' + region:<32} {selection['linear_regression_rmse']:>10.0f} "
+              f"{selection['xgboost_rmse']:>10.0f} {saved:>6}  {params}")
+
+    print(f"Selected {len(selections)} models in {time.perf_counter() - start:.2f} s")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
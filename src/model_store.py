@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import struct
+import numpy as np
+
+from src.compiled_model import CompiledLinearModel, CompiledTreeEnsemble, load_compiled_model
+
+# First bytes of a model store file, followed by the length of the JSON header as a little-endian uint64
+MAGIC = b'IMMOMS01'
+
+# Every array starts at a multiple of this many bytes, so the views of the arrays are aligned
+ALIGNMENT = 64
+
+
+def write_model_store(path, models):
+    """
+    Writes compiled models to a single model store file that workers can memory-map read-only.
+
+    The file holds a JSON header, describing every model and the dtype, shape and offset of each of its
+    arrays, followed by the raw arrays. The tree tables include the child arrays precomputed by
+    CompiledTreeEnsemble, so a worker that maps the file does not build any per-process copy of them.
+
+    The file is written to a temporary file in the same directory, flushed to disk and renamed over the
+    destination, so a worker always maps either the previous or the new file, never a partial one. The
+    previous file must never be modified in place: workers that mapped it keep reading its pages until
+    they switch to the new file.
+
+    Parameters:
+    path (str): The destination path of the store.
+    models (dict): The compiled models (CompiledLinearModel or CompiledTreeEnsemble), keyed by
+    (property_type, region).
+
+    Returns:
+    None
+    """
+    entries = {}
+    arrays = []
+    offset = 0
+
+    for (property_type, region), model in sorted(models.items()):
+        if isinstance(model, CompiledLinearModel):
+            entry = {'kind': 'linear', 'intercept': model.intercept}
+            model_arrays = {'coef': model.coef}
+        elif isinstance(model, CompiledTreeEnsemble):
+            entry = {'kind': 'tree_ensemble', 'base_score': model.base_score, 'n_features': model.n_features_in_,
+                     'depth': model._depth}
+            model_arrays = {
+                'roots': model.roots, 'left': model.left, 'right': model.right, 'feature': model.feature,
+                'threshold': model.threshold, 'default_left': model.default_left, 'value': model.value,
+                'next_left': model._next_left, 'next_right': model._next_right,
+            }
+        else:
+            raise TypeError(f"Cannot store a model of type {type(model).__name__}.")
+
+        entry.update(property_type=property_type, region=region, arrays={})
+        for name, array in model_arrays.items():
+            array = np.ascontiguousarray(array)
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+            entry['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            arrays.append((offset, array))
+            offset += array.nbytes
+
+        entries[f'{property_type}_{region}'] = entry
+
+    header = json.dumps({'models': entries}).encode()
+
+    # The array offsets are relative to the start of the data, which is aligned after the header
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for array_offset, array in arrays:
+            f.seek(data_start + array_offset)
+            f.write(array.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+class ModelStore:
+    """
+    Read-only, memory-mapped view of a model store file written by write_model_store.
+
+    The arrays of the models are views of a single read-only mapping of the file, so they are not copied
+    into the memory of the process: every worker that opens the same file shares one copy of its pages
+    through the OS page cache, whatever the number of workers. The mapping stays valid after the file is
+    replaced on disk, the process keeps the previous version until it opens the new one.
+
+    Parameters:
+    path (str): The path of the model store file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.version = (stat.st_ino, stat.st_mtime_ns)
+
+        self._buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self._buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a model store file.")
+
+        header_length, = struct.unpack('<Q', bytes(self._buffer[len(MAGIC):len(MAGIC) + 8]))
+        header_end = len(MAGIC) + 8 + header_length
+        self._entries = json.loads(bytes(self._buffer[len(MAGIC) + 8:header_end]))['models']
+        self._data_start = -(-header_end // ALIGNMENT) * ALIGNMENT
+
+        # Model objects are built on first use, and only hold views of the mapping
+        self._models = {}
+
+    def segments(self):
+        """
+        Lists the (property_type, region) segments that have a model in the store.
+
+        Returns:
+        list: A sorted list of (property_type, region) tuples.
+        """
+        return sorted((entry['property_type'], entry['region']) for entry in self._entries.values())
+
+    def get(self, property_type, region):
+        """
+        Returns the model for the given property type and region.
+
+        Parameters:
+        property_type (str): The type of property ('house' or 'apartment').
+        region (str): The region of the property.
+
+        Returns:
+        CompiledLinearModel or CompiledTreeEnsemble: The model, or None if the store has no model for this segment.
+        """
+        key = f'{property_type}_{region}'
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        arrays = {name: self._array(spec) for name, spec in entry['arrays'].items()}
+        if entry['kind'] == 'linear':
+            model = CompiledLinearModel(arrays['coef'], entry['intercept'])
+        elif entry['kind'] == 'tree_ensemble':
+            model = CompiledTreeEnsemble(
+                arrays['roots'], arrays['left'], arrays['right'], arrays['feature'], arrays['threshold'],
+                arrays['default_left'], arrays['value'], entry['base_score'], entry['n_features'],
+                next_left=arrays['next_left'], next_right=arrays['next_right'], depth=entry['depth']
+            )
+        else:
+            raise ValueError(f"Unknown compiled model kind '{entry['kind']}' in {self.path}.")
+
+        self._models[key] = model
+        return model
+
+    def _array(self, spec):
+        """
+        Returns a read-only view of an array of the store.
+
+        Parameters:
+        spec (dict): The dtype, shape and offset of the array, from the header.
+
+        Returns:
+        numpy.ndarray: The view of the array in the mapping.
+        """
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+
+        return np.frombuffer(self._buffer, dtype=dtype, count=count,
+                             offset=self._data_start + spec['offset']).reshape(spec['shape'])
+
+
+def build_model_store(models_dir='./models', path=None):
+    """
+    Packs every compiled model of the models directory into a model store file.
+
+    Parameters:
+    models_dir (str): The directory that contains the compiled models ('{property_type}_{region}_model.npz').
+    path (str): The path of the store. By default, 'model_store.bin' in the models directory.
+
+    Returns:
+    str: The path of the store.
+    """
+    if path is None:
+        path = os.path.join(models_dir, 'model_store.bin')
+
+    models = {}
+    for filename in sorted(os.listdir(models_dir)):
+        if not filename.endswith('_model.npz'):
+            continue
+
+        # The property type never contains an underscore, so the first one separates it from the region
+        property_type, _, region = filename[:-len('_model.npz')].partition('_')
+        models[(property_type, region)] = load_compiled_model(os.path.join(models_dir, filename))
+
+    write_model_store(path, models)
+
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack the compiled models into a single memory-mappable model store.')
+    parser.add_argument('--models-dir', default='./models', help='directory that contains the compiled models')
+    parser.add_argument('--out', default=None, help='path of the model store (default: model_store.bin in --models-dir)')
+    args = parser.parse_args(argv)
+
+    path = build_model_store(args.models_dir, args.out)
+    store = ModelStore(path)
+    print(f"Wrote {len(store.segments())} models to {path} ({os.path.getsize(path) / 2 ** 20:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
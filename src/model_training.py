@@ -1,22 +1,24 @@
 import os
+import json
 import pickle
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error, r2_score
-from xgboost import XGBRegressor
 
-os.makedirs('../models', exist_ok=True)
+# scikit-learn and XGBoost are imported by the functions that use them, so importing this module
+# (e.g. from a shared entry point or to compile models) does not load them
+from src.compiled_model import CompiledLinearModel, CompiledTreeEnsemble, save_compiled_model
 
-def train_and_test_model(model, X_train, X_test, y_train, y_test, property_type, region):
+# Maximum relative difference allowed between the predictions of a model and of its compiled version
+COMPILED_MODEL_TOLERANCE = 1e-5
+
+def train_and_test_model(model, X_train, X_test, y_train, y_test, property_type, region, models_dir='./models', save=True):
     """
     Trains a model on the provided training data and tests it on the test data. 
 
     This function fits the model on the training data, makes predictions on both training and test sets, 
     then calculates and prints the mean squared error (MSE) and coefficient of determination (R^2 score) 
-    for both the training and test sets.
+    for both the training and test sets. The model files are written atomically, so the API never
+    reads a partially written model.
 
     Parameters:
     model (sklearn.base.BaseEstimator): The machine learning model to be trained.
@@ -26,50 +28,66 @@ def train_and_test_model(model, X_train, X_test, y_train, y_test, property_type,
     y_test (numpy.ndarray): The test target set.
     property_type (str): The type of property, used for printing results.
     region (str): The region of the property, used for printing results.
+    models_dir (str): The directory the trained model is saved to.
+    save (bool): Whether to save the trained model.
 
     Returns:
-    None
+    dict: The train and test mean squared error and R^2 score of the model.
     """
 
-    # Drop the 'region' and 'property_type' features from the training and testing sets
-    X_train = X_train.drop(['Region', 'Type of property'], axis=1)
-    X_test = X_test.drop(['Region', 'Type of property'], axis=1)
+    # Drop the 'region' and 'property_type' features from the training and testing sets, if they are still there
+    if isinstance(X_train, pd.DataFrame):
+        X_train = X_train.drop(['Region', 'Type of property'], axis=1, errors='ignore')
+        X_test = X_test.drop(['Region', 'Type of property'], axis=1, errors='ignore')
+
+    from sklearn.metrics import mean_squared_error, r2_score
 
     # Fit the model to the training data
     model.fit(X_train, y_train)
 
     # Save the trained model to disk
-    filename = f'./models/{property_type}_{region}_model.pickle'
-    pickle.dump(model, open(filename, 'wb'))
+    if save:
+        save_segment_model(model, property_type, region, models_dir, X_test)
 
     # Make predictions on the training set and the test set
     y_train_pred = model.predict(X_train)
     y_test_pred = model.predict(X_test)
 
+    # Calculate the mean squared error and the coefficient of determination (R^2) for both sets
+    metrics = {
+        'mse_train': mean_squared_error(y_train, y_train_pred),
+        'mse_test': mean_squared_error(y_test, y_test_pred),
+        'r2_train': r2_score(y_train, y_train_pred),
+        'r2_test': r2_score(y_test, y_test_pred),
+    }
+
     # Calculate the mean squared error for the training set and print it
     print(f'Mean squared error (train) for {property_type} in {region}: %.2f'
-          % mean_squared_error(y_train, y_train_pred))
+          % metrics['mse_train'])
 
     # Calculate the mean squared error for the test set and print it
     print(f'Mean squared error (test) for {property_type} in {region}: %.2f'
-          % mean_squared_error(y_test, y_test_pred))
+          % metrics['mse_test'])
 
     # Calculate the coefficient of determination (R^2) for the training set and print it
     print(f'Coefficient of determination R^2 (train) for {property_type} in {region}: %.2f'
-          % r2_score(y_train, y_train_pred))
+          % metrics['r2_train'])
 
     # Calculate the coefficient of determination (R^2) for the test set and print it
     print(f'Coefficient of determination R^2 (test) for {property_type} in {region}: %.2f'
-          % r2_score(y_test, y_test_pred))
+          % metrics['r2_test'])
+
+    return metrics
+
 
-    
-def train_models(X_train, X_test, y_train, y_test, property_type, region):
+def train_models(X_train, X_test, y_train, y_test, property_type, region, models_dir='./models', n_jobs=None):
     """
     Trains both a Linear Regression and an XGBoost Regression model on the provided training data 
     and tests it on the test data.
 
     This function creates instances of LinearRegression and XGBRegressor models, then trains and tests 
     each model using the 'train_and_test_model' function, providing performance metrics for each model.
+    Only the model with the lowest test mean squared error is saved.
 
     Parameters:
     X_train (numpy.ndarray): The training feature set.
@@ -78,22 +96,40 @@ def train_models(X_train, X_test, y_train, y_test, property_type, region):
     y_test (numpy.ndarray): The test target set.
     property_type (str): The type of property, used for printing results.
     region (str): The region of the property, used for printing results.
+    models_dir (str): The directory the trained models are saved to.
+    n_jobs (int): The number of threads used by XGBoost. None lets XGBoost use all cores.
 
     Returns:
-    None
+    dict: The metrics of each model, keyed by model name ('linear_regression' and 'xgboost'), with
+    'selected' set to True for the model that was saved.
     """
+    from sklearn.linear_model import LinearRegression
+    from xgboost import XGBRegressor
+
+    metrics = {}
 
     # Train and test Linear Regression model
     print(f"----Linear Regression Results for {property_type} in {region}----")
     lr_model = LinearRegression()  # Create an instance of Linear Regression
-    train_and_test_model(lr_model, X_train, X_test, y_train, y_test, property_type, region)
+    metrics['linear_regression'] = train_and_test_model(lr_model, X_train, X_test, y_train, y_test, property_type, region, models_dir, save=False)
 
     # Train and test XGBoost Regression model
     print(f"----XGBoost Regression Results for {property_type} in {region}----")
-    xgb_model = XGBRegressor(objective ='reg:squarederror')  # Create an instance of XGBoost Regression and set the objective to 'reg:squarederror' to suppress a warning from XGBoost
-    train_and_test_model(xgb_model, X_train, X_test, y_train, y_test, property_type, region)
+    xgb_model = XGBRegressor(objective ='reg:squarederror', n_jobs=n_jobs)  # Create an instance of XGBoost Regression and set the objective to 'reg:squarederror' to suppress a warning from XGBoost
+    metrics['xgboost'] = train_and_test_model(xgb_model, X_train, X_test, y_train, y_test, property_type, region, models_dir, save=False)
+
+    # Both models share the same file, so save only the one with the lowest test error
+    best_name, best_model = min([('linear_regression', lr_model), ('xgboost', xgb_model)],
+                                key=lambda item: metrics[item[0]]['mse_test'])
+    save_segment_model(best_model, property_type, region, models_dir, X_test)
+
+    for name in metrics:
+        metrics[name]['selected'] = name == best_name
+    print(f"Saved the {best_name} model for {property_type} in {region}")
+
+    return metrics
 
-def split_data(X, y):
+def split_data(X, y, return_scaler=False):
     """
     Splits the data into training and test sets, and scales the features.
 
@@ -106,10 +142,14 @@ def split_data(X, y):
     Parameters:
     X (pandas.DataFrame): The input features.
     y (pandas.Series): The target variable.
+    return_scaler (bool): Whether to also return the fitted scaler (e.g. to scale new rows the same way later).
 
     Returns:
-    numpy.ndarray: The training feature set, test feature set, training target set, and test target set.
+    numpy.ndarray: The training feature set, test feature set, training target set, and test target set,
+    followed by the fitted StandardScaler if return_scaler is True.
     """
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import StandardScaler
 
     # Split the data into training and test sets (80-20 split)
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
@@ -124,4 +164,177 @@ def split_data(X, y):
     X_test = scaler.transform(X_test)
 
     # Return the training and test sets
+    if return_scaler:
+        return X_train, X_test, y_train, y_test, scaler
     return X_train, X_test, y_train, y_test
+
+
+def save_model(model, filename):
+    """
+    Pickles a model to disk atomically.
+
+    The model is first written to a temporary file in the same directory, which then replaces the
+    destination file, so readers see either the previous model or the new one, never a partial file.
+
+    Parameters:
+    model (object): The model to save.
+    filename (str): The destination path of the pickle.
+
+    Returns:
+    None
+    """
+    temporary_filename = f'{filename}.{os.getpid()}.tmp'
+
+    with open(temporary_filename, 'wb') as f:
+        pickle.dump(model, f)
+
+    os.replace(temporary_filename, filename)
+
+
+def save_segment_model(model, property_type, region, models_dir='./models', X=None):
+    """
+    Saves the model of a segment, both pickled and compiled, to the models directory.
+
+    Parameters:
+    model (LinearRegression or XGBRegressor): The trained model.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+    models_dir (str): The directory the model is saved to.
+    X (numpy.ndarray): Optional feature matrix used to check the compiled model against the original one.
+
+    Returns:
+    None
+    """
+    os.makedirs(models_dir, exist_ok=True)
+
+    filename = os.path.join(models_dir, f'{property_type}_{region}_model.pickle')
+    save_model(model, filename)
+
+    # Save the compiled version of the model next to it, so the API can serve it without pickle and xgboost
+    export_compiled_model(model, filename[:-len('.pickle')] + '.npz', X)
+
+
+def compile_model(model):
+    """
+    Converts a trained model to a pickle-free compiled model that only needs NumPy for inference.
+
+    A LinearRegression model is reduced to its coefficients and intercept. An XGBRegressor model is
+    flattened to a table of tree nodes, keeping only the boosting rounds that its predict method uses.
+
+    Parameters:
+    model (LinearRegression or XGBRegressor): The trained model.
+
+    Returns:
+    CompiledLinearModel or CompiledTreeEnsemble: The compiled model.
+    """
+    from sklearn.linear_model import LinearRegression
+    from xgboost import XGBRegressor
+
+    if isinstance(model, LinearRegression):
+        return CompiledLinearModel(model.coef_, model.intercept_)
+
+    if not isinstance(model, XGBRegressor):
+        raise TypeError(f"Cannot compile a model of type {type(model).__name__}.")
+
+    booster = model.get_booster()
+    learner = json.loads(booster.save_raw('json'))['learner']
+
+    # Only the identity link of the squared error objective is supported by the evaluator
+    objective = learner['objective']['name']
+    if objective != 'reg:squarederror':
+        raise ValueError(f"Cannot compile an XGBoost model with objective '{objective}'.")
+
+    trees = learner['gradient_booster']['model']['trees']
+
+    # Keep the trees of the rounds used by predict (all of them, unless early stopping was used)
+    best_iteration = booster.attr('best_iteration')
+    if best_iteration is not None:
+        rounds = int(best_iteration) + 1
+        trees = trees[:rounds * (len(trees) // booster.num_boosted_rounds())]
+
+    # Concatenate the nodes of all trees, shifting the child indices of each tree by its offset
+    roots, left, right, feature, threshold, default_left, value = [], [], [], [], [], [], []
+    for tree in trees:
+        offset = len(left)
+        roots.append(offset)
+
+        tree_left = np.array(tree['left_children'], dtype=np.int32)
+        tree_right = np.array(tree['right_children'], dtype=np.int32)
+        is_leaf = tree_left == -1
+
+        left.extend(np.where(is_leaf, -1, tree_left + offset))
+        right.extend(np.where(is_leaf, -1, tree_right + offset))
+        feature.extend(tree['split_indices'])
+        default_left.extend(tree['default_left'])
+
+        # For leaves, XGBoost stores the leaf output in place of the split condition
+        conditions = np.array(tree['split_conditions'], dtype=np.float32)
+        threshold.extend(np.where(is_leaf, 0, conditions))
+        value.extend(np.where(is_leaf, conditions, 0))
+
+    # The base score is stored as a string, e.g. '5E-1' or '[5E-1]' depending on the XGBoost version
+    base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+    n_features = int(learner['learner_model_param']['num_feature'])
+
+    return CompiledTreeEnsemble(roots, left, right, feature, threshold, default_left, value, base_score, n_features)
+
+
+def export_compiled_model(model, filename, X=None):
+    """
+    Compiles a trained model, checks that it predicts the same values as the original and saves it.
+
+    The predictions of the compiled model are compared with those of the original model on X, or on random
+    data when X is not given. The relative difference must stay below COMPILED_MODEL_TOLERANCE.
+
+    Parameters:
+    model (LinearRegression or XGBRegressor): The trained model.
+    filename (str): The destination path of the compiled model (.npz).
+    X (numpy.ndarray): Optional feature matrix used to compare the predictions.
+
+    Returns:
+    CompiledLinearModel or CompiledTreeEnsemble: The compiled model.
+    """
+    compiled = compile_model(model)
+
+    # Use random standardized features when no data is given, which covers both sides of most splits
+    if X is None:
+        X = np.random.default_rng(42).normal(size=(1000, compiled.n_features_in_))
+
+    expected = np.asarray(model.predict(X), dtype=np.float64)
+    actual = compiled.predict(X).astype(np.float64)
+
+    max_difference = np.max(np.abs(actual - expected) / np.maximum(np.abs(expected), 1.0))
+    if max_difference > COMPILED_MODEL_TOLERANCE:
+        raise ValueError(f"The compiled model differs from the original model by {max_difference:.2e} "
+                         f"(tolerance {COMPILED_MODEL_TOLERANCE:.0e}).")
+
+    save_compiled_model(filename, compiled)
+
+    return compiled
+
+
+def compile_models(models_dir='./models'):
+    """
+    Compiles every pickled model in the models directory and saves it next to the pickle as a .npz file.
+
+    Parameters:
+    models_dir (str): The directory that contains the pickled models.
+
+    Returns:
+    list: The paths of the compiled models.
+    """
+    compiled_paths = []
+
+    for filename in sorted(os.listdir(models_dir)):
+        if not filename.endswith('_model.pickle'):
+            continue
+
+        path = os.path.join(models_dir, filename)
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+
+        compiled_path = path[:-len('.pickle')] + '.npz'
+        export_compiled_model(model, compiled_path)
+        compiled_paths.append(compiled_path)
+
+    return compiled_paths
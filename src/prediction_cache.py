@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """
+    Bounded cache of predictions, keyed by segment and rounded features.
+
+    The features are rounded to the given number of decimals before they are used as a key, so near-identical
+    requests (e.g. a living area of 120.2 and 119.9 m² with decimals=0) share the same entry, and get the
+    prediction computed for the first of them. The cache holds at most max_size entries and drops the least
+    recently used one when it is full. Entries also expire ttl seconds after they were added, if a ttl is set.
+
+    Every segment has a generation number, bumped whenever its model changes. A request reads it before
+    predicting and passes it to put, so a prediction made by a model that was replaced in the meantime is not
+    cached. The keys of every segment are also indexed, so the entries of a segment are dropped without
+    scanning the whole cache.
+
+    Parameters:
+    max_size (int): The maximum number of entries.
+    ttl (float): The number of seconds an entry stays valid. None means entries never expire.
+    decimals (int): The number of decimals the features are rounded to in the key.
+    """
+
+    def __init__(self, max_size=10000, ttl=None, decimals=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.decimals = decimals
+
+        # Entries, ordered from least to most recently used, with the time they expire at
+        self._entries = OrderedDict()
+
+        # Keys of the entries of every segment, and the generation of the model of every segment
+        self._segment_keys = {}
+        self._generations = {}
+
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def key(self, segment, features):
+        """
+        Returns the cache key of a prediction.
+
+        Parameters:
+        segment (tuple): The (type_of_property, region) segment.
+        features (iterable): The feature values.
+
+        Returns:
+        tuple: The segment and the rounded feature values.
+        """
+        return segment, tuple(round(float(value), self.decimals) for value in features)
+
+    def get(self, segment, features):
+        """
+        Returns the cached prediction for the given segment and features.
+
+        Parameters:
+        segment (tuple): The (type_of_property, region) segment.
+        features (iterable): The feature values.
+
+        Returns:
+        float: The cached prediction, or None if there is no valid entry.
+        """
+        key = self.key(segment, features)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            prediction, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prediction
+
+    def generation(self, segment):
+        """
+        Returns the generation of the model of a segment, to read before predicting and pass to put.
+
+        Parameters:
+        segment (tuple): The (type_of_property, region) segment.
+
+        Returns:
+        int: The number of times the model of the segment changed.
+        """
+        return self._generations.get(segment, 0)
+
+    def put(self, segment, features, prediction, generation=None):
+        """
+        Adds a prediction to the cache, evicting the least recently used entries if the cache is full.
+
+        Parameters:
+        segment (tuple): The (type_of_property, region) segment.
+        features (iterable): The feature values.
+        prediction (float): The prediction.
+        generation (int): The generation of the segment read before predicting. If the model of the segment
+        changed since, the prediction is not cached. None caches it unconditionally.
+
+        Returns:
+        None
+        """
+        key = self.key(segment, features)
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            if generation is not None and generation != self._generations.get(segment, 0):
+                self.stale_puts += 1
+                return
+
+            self._entries[key] = (prediction, expires_at)
+            self._entries.move_to_end(key)
+            self._segment_keys.setdefault(segment, set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, segment=None):
+        """
+        Removes the entries of a segment, or all entries.
+
+        Parameters:
+        segment (tuple): The (type_of_property, region) segment. None removes every entry.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            if segment is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._segment_keys.clear()
+                return
+
+            keys = self._segment_keys.pop(segment, ())
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+
+    def on_model_event(self, event, property_type, region, seconds):
+        """
+        Model registry listener that drops the predictions of a segment whenever its model changes, and bumps
+        its generation so that the predictions of requests still using the previous model are not cached.
+
+        A first load, or an eviction from memory, leaves the model file unchanged, so the cached predictions
+        stay valid. Only a reload from a changed file and the removal of the model drop them.
+
+        Returns:
+        None
+        """
+        if event not in ('reload', 'remove'):
+            return
+
+        segment = (property_type, region)
+        with self._lock:
+            self._generations[segment] = self._generations.get(segment, 0) + 1
+        self.invalidate(segment)
+
+    def _remove(self, key):
+        """
+        Removes an entry and its key from the index of its segment. The lock must be held.
+
+        Parameters:
+        key (tuple): The key of the entry.
+
+        Returns:
+        None
+        """
+        del self._entries[key]
+
+        segment_keys = self._segment_keys[key[0]]
+        segment_keys.discard(key)
+        if not segment_keys:
+            del self._segment_keys[key[0]]
+
+    def stats(self):
+        """
+        Returns the size and the counters of the cache.
+
+        Returns:
+        dict: The number of entries, the maximum size, and the number of hits, misses, evictions,
+        expirations, invalidations and predictions not cached because their model was replaced.
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'stale_puts': self.stale_puts,
+            }
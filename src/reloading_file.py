@@ -0,0 +1,55 @@
+import threading
+import time
+
+from src.model_registry import file_version
+
+
+class ReloadingFile:
+    """
+    Object loaded from a file, and loaded again when the file changes.
+
+    The version of the file, its inode and modification time, is checked at most every check_interval seconds,
+    so a file renamed over the previous one is picked up even if its modification time was preserved. A new
+    object is fully loaded before it replaces the previous one, so the file can be rebuilt or updated on disk
+    (by renaming a new file over it) while the API is serving the object.
+
+    Parameters:
+    path (str): The path of the file.
+    load (callable): The function that loads the object from the path of the file.
+    check_interval (float): The minimum number of seconds between two checks of the file.
+    """
+
+    def __init__(self, path, load, check_interval=5.0):
+        self.path = path
+        self.load = load
+        self.check_interval = check_interval
+
+        self._value = None
+        self._version = None
+        self._last_check = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the object, loading it again if its file changed since the last check.
+
+        Returns:
+        object: The loaded object, or None if the file does not exist.
+        """
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self.check_interval:
+            return self._value
+
+        with self._lock:
+            self._last_check = now
+            try:
+                version = file_version(self.path)
+            except FileNotFoundError:
+                self._value, self._version = None, None
+                return None
+
+            if version != self._version:
+                self._value = self.load(self.path)
+                self._version = version
+
+            return self._value
@@ -0,0 +1,293 @@
+import argparse
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from src.data_preprocessing import (PROPERTY_DATA_DTYPES, RunningCorrelation, map_regions, filter_data,
+                                    save_frame, load_frame)
+
+# Directory of the output directory the files of a run are written to before they are moved into the partitions,
+# and the file written in it once all of them are complete
+STAGING_DIR = '.staging'
+COMMITTED_MARKER = 'COMMITTED'
+
+
+class RowHashIndex:
+    """
+    Compact index of the rows seen so far, used to drop duplicate rows across chunks.
+
+    Each row is reduced to a 64-bit hash, and the hashes are kept in a sorted NumPy array, so the index
+    costs 8 bytes per distinct row whatever the width of the rows. Two distinct rows are only mistaken
+    for duplicates if their hashes collide, which is negligible for 64-bit hashes at these sizes.
+    """
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return self.hashes.shape[0]
+
+    def save(self, path):
+        """
+        Saves the hashes to a .npy file.
+
+        Parameters:
+        path (str): The path of the .npy file.
+
+        Returns:
+        None
+        """
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            np.save(f, self.hashes)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads hashes saved by save.
+
+        Parameters:
+        path (str): The path of the .npy file.
+
+        Returns:
+        RowHashIndex: The loaded index.
+        """
+        index = cls()
+        index.hashes = np.load(path, allow_pickle=False)
+        return index
+
+    def add_new(self, df):
+        """
+        Adds the rows of a DataFrame to the index and returns the rows that were not seen before.
+
+        Parameters:
+        df (pandas.DataFrame): The rows of a chunk.
+
+        Returns:
+        pandas.DataFrame: The rows that were neither in a previous chunk nor earlier in this chunk.
+        """
+        hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+        # Keep the first occurrence of every hash within the chunk, then the hashes not seen in previous chunks
+        _, first = np.unique(hashes, return_index=True)
+        first.sort()
+        first = first[~np.isin(hashes[first], self.hashes, assume_unique=True)]
+
+        self.hashes = np.union1d(self.hashes, hashes[first])
+
+        return df.iloc[first]
+
+
+def stream_preprocess(path, out_dir, chunksize=100000, append=False):
+    """
+    Cleans a property data csv file chunk by chunk and writes one partition per (property_type, region).
+
+    This is the streaming equivalent of load_and_clean_data followed by filter_data on every segment,
+    for files that do not fit in memory. Each chunk is read with the compact dtypes of PROPERTY_DATA_DTYPES,
+    mapped to regions, de-duplicated against all previous chunks, and split by segment. The rows of every
+    segment are appended to its partition directory, and the running correlation statistics needed by
+    drop_highly_correlated_features are updated, so the peak memory only depends on the chunk size
+    (plus 8 bytes per distinct row for the duplicate index).
+
+    The output directory receives, for every segment, a '{property_type}_{region}' directory with the rows
+    in 'part-00000.npz', 'part-00001.npz', ... and the statistics in 'correlation.npz', and the duplicate
+    index in 'row_hashes.npy'. It must be new or empty, unless append is True: the rows of the csv file are
+    then added to the existing partitions. Rows already in the partitions are skipped, and the statistics are
+    updated with the new rows only, so a fresh scrape is merged without reading the previous ones again.
+
+    The parts, statistics and duplicate index of a run are first written to the STAGING_DIR directory, and
+    only moved into the partitions once all of them are written (see commit_staging). A run that crashes
+    therefore leaves the partitions as they were, and running it again does not add the same rows twice.
+
+    Parameters:
+    path (str): The file path to the csv data.
+    out_dir (str): The directory the partitions are written to.
+    chunksize (int): The number of csv rows read at once.
+    append (bool): Whether to add the rows to the partitions already in out_dir.
+
+    Returns:
+    dict: For every (property_type, region) segment that received rows, its number of new rows and its
+    RunningCorrelation statistics.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    recover_staging(out_dir)
+    if os.listdir(out_dir) and not append:
+        raise FileExistsError(f"The output directory '{out_dir}' is not empty.")
+
+    staging_dir = os.path.join(out_dir, STAGING_DIR)
+    os.makedirs(staging_dir)
+
+    index_path = os.path.join(out_dir, 'row_hashes.npy')
+    index = RowHashIndex.load(index_path) if os.path.exists(index_path) else RowHashIndex()
+    segments = {}
+
+    # Number the new parts after the existing ones, so they sort after them
+    existing_parts = [int(filename[len('part-'):-len('.npz')])
+                      for property_type, region in list_partitions(out_dir)
+                      for filename in os.listdir(os.path.join(out_dir, f'{property_type}_{region}'))
+                      if filename.startswith('part-')]
+    part = max(existing_parts, default=-1) + 1
+
+    for chunk in pd.read_csv(path, usecols=list(PROPERTY_DATA_DTYPES), dtype=PROPERTY_DATA_DTYPES, chunksize=chunksize):
+        # Drop the rows already seen in this chunk or in a previous one
+        chunk = index.add_new(chunk)
+
+        # Add the 'Region' column and drop the columns that were only needed for cleaning
+        chunk = chunk.assign(Region=map_regions(chunk['Zip code']))
+        chunk = chunk.drop(columns=['ID number', 'Zip code'])
+
+        for (property_type, region), group_df in chunk.groupby(['Type of property', 'Region'], observed=True):
+            group_df = filter_data(group_df, property_type, region)
+            if group_df.empty:
+                continue
+
+            segment_dir = os.path.join(staging_dir, f'{property_type}_{region}')
+            if (property_type, region) not in segments:
+                os.makedirs(segment_dir, exist_ok=True)
+
+                # Continue from the statistics of the existing partition, if there is one
+                statistics_path = os.path.join(out_dir, f'{property_type}_{region}', 'correlation.npz')
+                if os.path.exists(statistics_path):
+                    statistics = RunningCorrelation.load(statistics_path)
+                else:
+                    statistics = RunningCorrelation(group_df.select_dtypes(include=[np.number]).columns)
+                segments[(property_type, region)] = {'rows': 0, 'statistics': statistics}
+
+            segment = segments[(property_type, region)]
+            segment['rows'] += len(group_df)
+            segment['statistics'].update(group_df)
+
+            save_frame(group_df.reset_index(drop=True), os.path.join(segment_dir, f'part-{part:05d}.npz'))
+
+        part += 1
+
+    for (property_type, region), segment in segments.items():
+        segment['statistics'].save(os.path.join(staging_dir, f'{property_type}_{region}', 'correlation.npz'))
+
+    index.save(os.path.join(staging_dir, 'row_hashes.npy'))
+
+    # Every file of the run is written: mark the run as complete, then move its files into the partitions
+    with open(os.path.join(staging_dir, COMMITTED_MARKER), 'w'):
+        pass
+    commit_staging(out_dir)
+
+    return segments
+
+
+def commit_staging(out_dir):
+    """
+    Moves the files of a complete run of stream_preprocess from the STAGING_DIR directory into the partitions.
+
+    Every file replaces the file with the same path in the output directory, and the staging directory,
+    with its COMMITTED_MARKER file, is removed last. If this is interrupted, calling it again moves the
+    remaining files, so the run is either fully applied or not at all.
+
+    Parameters:
+    out_dir (str): The directory the partitions are written to.
+
+    Returns:
+    None
+    """
+    staging_dir = os.path.join(out_dir, STAGING_DIR)
+
+    for directory, _, filenames in os.walk(staging_dir):
+        destination_dir = os.path.join(out_dir, os.path.relpath(directory, staging_dir))
+        os.makedirs(destination_dir, exist_ok=True)
+
+        for filename in filenames:
+            if directory != staging_dir or filename != COMMITTED_MARKER:
+                os.replace(os.path.join(directory, filename), os.path.join(destination_dir, filename))
+
+    shutil.rmtree(staging_dir)
+
+
+def recover_staging(out_dir):
+    """
+    Completes or discards the files left in the STAGING_DIR directory by a run of stream_preprocess that crashed.
+
+    A run that wrote all its files (it has the COMMITTED_MARKER file) is moved into the partitions, and the
+    files of a run that did not are removed, as its rows were never added to the duplicate index.
+
+    Parameters:
+    out_dir (str): The directory the partitions are written to.
+
+    Returns:
+    None
+    """
+    staging_dir = os.path.join(out_dir, STAGING_DIR)
+    if not os.path.isdir(staging_dir):
+        return
+
+    if os.path.exists(os.path.join(staging_dir, COMMITTED_MARKER)):
+        commit_staging(out_dir)
+    else:
+        shutil.rmtree(staging_dir)
+
+
+def list_partitions(out_dir):
+    """
+    Lists the segments written by stream_preprocess.
+
+    Parameters:
+    out_dir (str): The directory the partitions were written to.
+
+    Returns:
+    list: A sorted list of (property_type, region) tuples.
+    """
+    segments = []
+    for name in os.listdir(out_dir):
+        # The property type never contains an underscore, so the first one separates it from the region
+        property_type, _, region = name.partition('_')
+        if region and os.path.isdir(os.path.join(out_dir, name)):
+            segments.append((property_type, region))
+
+    return sorted(segments)
+
+
+def load_partition(out_dir, property_type, region):
+    """
+    Loads the rows and the correlation statistics of one segment written by stream_preprocess.
+
+    Only this segment is read, so a single segment can be preprocessed and trained on at a time.
+
+    Parameters:
+    out_dir (str): The directory the partitions were written to.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+
+    Returns:
+    tuple: The rows of the segment as a DataFrame, and its RunningCorrelation statistics.
+    """
+    segment_dir = os.path.join(out_dir, f'{property_type}_{region}')
+    parts = sorted(filename for filename in os.listdir(segment_dir) if filename.startswith('part-'))
+
+    group_df = pd.concat([load_frame(os.path.join(segment_dir, filename))[0] for filename in parts], ignore_index=True)
+
+    # The categories differ from one chunk to the other, so the categorical columns are rebuilt
+    group_df['Type of property'] = group_df['Type of property'].astype(str).astype('category')
+    group_df['Region'] = group_df['Region'].astype(str).astype('category')
+
+    statistics = RunningCorrelation.load(os.path.join(segment_dir, 'correlation.npz'))
+
+    return group_df, statistics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Clean a property data csv file in chunks and partition it by segment.')
+    parser.add_argument('data', help='path of the property data csv file')
+    parser.add_argument('out_dir', help='new or empty directory the partitions are written to')
+    parser.add_argument('--chunksize', type=int, default=100000, help='number of csv rows read at once')
+    parser.add_argument('--append', action='store_true', help='add the new rows to the existing partitions of out_dir')
+    args = parser.parse_args(argv)
+
+    segments = stream_preprocess(args.data, args.out_dir, args.chunksize, args.append)
+
+    for (property_type, region), segment in sorted(segments.items()):
+        dropped = ', '.join(segment['statistics'].columns_to_drop()) or 'none'
+        print(f"{property_type} / {region}: {segment['rows']} new rows, highly correlated columns: {dropped}")
+
+
+if __name__ == '__main__':
+    main()
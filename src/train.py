@@ -0,0 +1,549 @@
+import argparse
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from src.data_preprocessing import load_and_clean_data, filter_data, preprocess_group_df
+from src.model_training import train_models, split_data, save_segment_model
+from src.streaming import RowHashIndex, list_partitions, load_partition
+
+# Manifest of the last training of every segment, written in the models directory
+MANIFEST_FILENAME = 'training_manifest.json'
+
+# Directory, in the models directory, with the hashes of the rows every segment was last trained on
+ROW_HASHES_DIR = 'training_state'
+
+# Number of boosting rounds added to an XGBoost model when a segment only received new rows
+WARM_START_ROUNDS = 20
+
+# Drift limits above which a segment that only received new rows is refitted from scratch instead:
+# the error of the current model on the new rows relative to its test error, the largest shift of the mean
+# of a feature of the new rows (in standard deviations of the training rows), and the share of new rows
+MAX_ERROR_RATIO = 1.5
+MAX_MEAN_SHIFT = 0.5
+MAX_NEW_ROWS_FRACTION = 0.5
+
+# Minimum number of held out new rows for their error to replace the test error of a warm-started model,
+# which is the denominator of the error ratio of the next drift check
+MIN_HELD_OUT_ROWS = 30
+
+
+def prepare_segment(group_df, property_type, region, statistics=None):
+    """
+    Filters and preprocesses the rows of a segment, and splits them into features and target.
+
+    Parameters:
+    group_df (pandas.DataFrame): The rows of the segment, as returned by load_and_clean_data.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+    statistics (RunningCorrelation): Optional running correlation statistics of the segment.
+
+    Returns:
+    tuple: The features (pandas.DataFrame) and the target (pandas.Series).
+    """
+    group_df = filter_data(group_df, property_type, region)
+    group_df = preprocess_group_df(group_df, property_type, statistics)
+
+    # 'Price of property in euro' is the target variable
+    X = group_df.drop(['Price of property in euro', 'Type of property', 'Region'], axis=1)
+    y = group_df['Price of property in euro']
+
+    return X, y
+
+
+def row_hashes(group_df):
+    """
+    Computes a 64-bit hash of every row of a segment, used to find out which rows changed since the last training.
+
+    Parameters:
+    group_df (pandas.DataFrame): The filtered rows of the segment.
+
+    Returns:
+    numpy.ndarray: The hash of every row, in the order of the rows.
+    """
+    return pd.util.hash_pandas_object(group_df, index=False).to_numpy()
+
+
+def fingerprint(hashes):
+    """
+    Computes the fingerprint of a set of rows from their hashes, whatever the order of the rows.
+
+    Parameters:
+    hashes (numpy.ndarray): The row hashes.
+
+    Returns:
+    str: The SHA-256 hash of the sorted distinct row hashes.
+    """
+    return hashlib.sha256(np.unique(hashes).astype('<u8').tobytes()).hexdigest()
+
+
+def row_hashes_path(models_dir, property_type, region):
+    """
+    Returns the path of the hashes of the rows a segment was last trained on.
+
+    Parameters:
+    models_dir (str): The directory the models are saved to.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+
+    Returns:
+    str: The path of the .npy file in the ROW_HASHES_DIR directory.
+    """
+    return os.path.join(models_dir, ROW_HASHES_DIR, f'{property_type}_{region}_rows.npy')
+
+
+def model_file_hash(models_dir, property_type, region):
+    """
+    Computes the hash of the pickled model file of a segment, to find out whether it was rewritten since it was recorded.
+
+    Parameters:
+    models_dir (str): The directory the models are saved to.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+
+    Returns:
+    str: The SHA-256 hash of the file.
+    """
+    with open(os.path.join(models_dir, f'{property_type}_{region}_model.pickle'), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def record_training(entry, hashes, model, metrics, models_dir, property_type, region):
+    """
+    Records the state the next incremental training compares a segment with, after its model was saved.
+
+    The manifest entry is updated with the fingerprint and number of the rows, and the kind, test metrics and
+    file hash of the model, and the hashes of the rows are saved in the ROW_HASHES_DIR directory.
+
+    Parameters:
+    entry (dict): The manifest entry of the segment, updated in place.
+    hashes (numpy.ndarray): The hashes of the filtered rows of the segment.
+    model (str): The kind of the saved model ('linear_regression' or 'xgboost').
+    metrics (dict): The test metrics of the saved model ('mse_test' and 'r2_test').
+    models_dir (str): The directory the models are saved to.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+
+    Returns:
+    dict: The updated manifest entry.
+    """
+    entry.update(fingerprint=fingerprint(hashes), rows=len(hashes), model=model,
+                 mse_test=float(metrics['mse_test']), r2_test=float(metrics['r2_test']),
+                 model_hash=model_file_hash(models_dir, property_type, region),
+                 trained_at=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'))
+
+    index = RowHashIndex()
+    index.hashes = np.unique(hashes)
+    path = row_hashes_path(models_dir, property_type, region)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    index.save(path)
+
+    return entry
+
+
+def plan_segment(previous, previous_hashes, hashes, models_dir, property_type, region):
+    """
+    Decides how to retrain a segment from its previous training and its current rows.
+
+    The previous training is only trusted if the model file on disk is still the one it saved: a model written
+    by anything else (e.g. an older version of the pipeline) does not match the recorded rows and scaler.
+
+    Parameters:
+    previous (dict): The manifest entry of the previous training of the segment, or None.
+    previous_hashes (numpy.ndarray): The sorted hashes of the rows of the previous training, or None.
+    hashes (numpy.ndarray): The hashes of the current rows.
+    models_dir (str): The directory the models are saved to.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+
+    Returns:
+    tuple: The action ('skip', 'warm_start' or 'full_refit') and the reason for it.
+    """
+    if previous is None or previous_hashes is None or 'fingerprint' not in previous:
+        return 'full_refit', 'no previous training'
+
+    if not os.path.exists(os.path.join(models_dir, f'{property_type}_{region}_model.pickle')):
+        return 'full_refit', 'no previous model file'
+
+    if previous.get('model_hash') != model_file_hash(models_dir, property_type, region):
+        return 'full_refit', 'model file changed since the last training'
+
+    if fingerprint(hashes) == previous['fingerprint']:
+        return 'skip', 'rows unchanged'
+
+    if not np.isin(previous_hashes, hashes).all():
+        return 'full_refit', 'rows changed or removed'
+
+    if previous['model'] != 'xgboost':
+        return 'full_refit', f"rows appended, but the {previous['model']} model cannot be warm-started"
+
+    return 'warm_start', 'rows appended'
+
+
+def warm_start_segment(group_df, hashes, previous, previous_hashes, property_type, region, models_dir, n_jobs,
+                       statistics=None):
+    """
+    Continues boosting the XGBoost model of a segment that only received new rows.
+
+    The rows are scaled with the scaler of the previous training, so the existing trees keep their meaning.
+    The drift of the new rows is measured first: the error of the current model on them, the shift of the
+    means of their features and their share of the segment. If any of them is above its limit, nothing is
+    trained and None is returned, so that the segment is refitted from scratch. Otherwise WARM_START_ROUNDS
+    boosting rounds are added on the previous rows and the new rows. When 20% of the new rows are at least
+    MIN_HELD_OUT_ROWS rows, they are held out to measure the test metrics of the new model. Otherwise all the
+    new rows are trained on and the test metrics of the previous training are kept, as the error on a handful
+    of rows would be too noisy to be the baseline of the next drift check.
+
+    Parameters:
+    group_df (pandas.DataFrame): The rows of the segment, as returned by load_and_clean_data.
+    hashes (numpy.ndarray): The hashes of the filtered rows of the segment.
+    previous (dict): The manifest entry of the previous training of the segment.
+    previous_hashes (numpy.ndarray): The sorted hashes of the rows of the previous training.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+    models_dir (str): The directory the models are saved to.
+    n_jobs (int): The number of threads used by XGBoost.
+    statistics (RunningCorrelation): Optional running correlation statistics of the segment.
+
+    Returns:
+    tuple: The drift metrics (or the new features if they changed), and the metrics of the new model
+    keyed by model name, or None if the drift is too large or the features changed.
+    """
+    from sklearn.metrics import mean_squared_error, r2_score
+    from xgboost import XGBRegressor
+
+    X, y = prepare_segment(group_df, property_type, region, statistics)
+    if list(X.columns) != previous['features']:
+        return {'features': list(X.columns)}, None
+
+    scaler = previous['scaler']
+    X = (X.to_numpy(dtype=np.float64) - np.array(scaler['mean'])) / np.array(scaler['scale'])
+    y = y.to_numpy(dtype=np.float64)
+    new = ~np.isin(hashes, previous_hashes)
+
+    with open(os.path.join(models_dir, f'{property_type}_{region}_model.pickle'), 'rb') as f:
+        model = pickle.load(f)
+
+    drift = {
+        'new_rows': int(new.sum()),
+        'new_rows_fraction': float(new.sum() / max(previous['rows'], 1)),
+        'error_ratio': float(mean_squared_error(y[new], model.predict(X[new])) / previous['mse_test']),
+        'max_mean_shift': float(np.abs(X[new].mean(axis=0)).max()),
+    }
+    if (drift['error_ratio'] > MAX_ERROR_RATIO or drift['max_mean_shift'] > MAX_MEAN_SHIFT
+            or drift['new_rows_fraction'] > MAX_NEW_ROWS_FRACTION):
+        return drift, None
+
+    # Hold out 20% of the new rows to evaluate the new model, which is trained on all the other rows
+    new_rows = np.flatnonzero(new)
+    held_out = np.random.default_rng(42).permutation(new_rows)[:len(new_rows) // 5]
+    if len(held_out) < MIN_HELD_OUT_ROWS:
+        held_out = held_out[:0]
+    train = np.ones(len(y), dtype=bool)
+    train[held_out] = False
+
+    warm_model = XGBRegressor(**dict(model.get_params(), n_estimators=WARM_START_ROUNDS, n_jobs=n_jobs))
+    warm_model.fit(X[train], y[train], xgb_model=model.get_booster())
+    save_segment_model(warm_model, property_type, region, models_dir, X[~train] if len(held_out) else X[train])
+
+    # Without enough held out rows, the test error of the previous training is kept
+    metrics = {'mse_test': previous['mse_test'], 'r2_test': previous['r2_test']}
+    if len(held_out):
+        predictions = warm_model.predict(X[held_out])
+        metrics = {'mse_test': float(mean_squared_error(y[held_out], predictions)),
+                   'r2_test': float(r2_score(y[held_out], predictions))}
+    print(f"Added {WARM_START_ROUNDS} boosting rounds to the xgboost model for {property_type} in {region} "
+          f"with {drift['new_rows']} new rows")
+
+    return drift, {'xgboost': dict(metrics, selected=True)}
+
+
+def train_segment(group_df, property_type, region, models_dir, n_jobs, statistics=None, previous=None,
+                  incremental=False):
+    """
+    Runs the training pipeline for a single (property_type, region) segment.
+
+    The group is filtered and preprocessed, split into training and test sets, and both models are
+    trained, evaluated and saved. The output printed by the training functions is captured instead of
+    being written to the console, so that the output of segments trained in parallel does not interleave.
+
+    The hashes of the filtered rows are saved in the ROW_HASHES_DIR directory of the models directory, and
+    the summary holds the manifest entry of the segment. When incremental is True, the segment is compared
+    with its previous training: it is skipped if its rows did not change, and its XGBoost model is
+    warm-started if it only received new rows (see warm_start_segment). Otherwise it is refitted from scratch.
+
+    Parameters:
+    group_df (pandas.DataFrame): The rows of the segment, as returned by load_and_clean_data.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+    models_dir (str): The directory the trained models are saved to.
+    n_jobs (int): The number of threads used by XGBoost.
+    statistics (RunningCorrelation): Optional running correlation statistics of the segment.
+    previous (dict): The manifest entry of the previous training of the segment, or None.
+    incremental (bool): Whether to skip or warm-start the segment when its previous training allows it.
+
+    Returns:
+    dict: A summary of the segment with its number of rows, wall-clock time, metrics, training log and
+    manifest entry, or the error message if the training failed.
+    """
+    start = time.perf_counter()
+    log = io.StringIO()
+    summary = {'property_type': property_type, 'region': region}
+
+    try:
+        with contextlib.redirect_stdout(log):
+            hashes = row_hashes(filter_data(group_df, property_type, region))
+            hashes_path = row_hashes_path(models_dir, property_type, region)
+            previous_hashes = RowHashIndex.load(hashes_path).hashes if os.path.exists(hashes_path) else None
+
+            action, reason = 'full_refit', 'full retraining requested'
+            if incremental:
+                action, reason = plan_segment(previous, previous_hashes, hashes, models_dir, property_type, region)
+
+            entry = dict(previous or {})
+            entry.pop('drift', None)
+
+            if action == 'skip':
+                print(f"Skipped {property_type} in {region}: {reason}")
+                summary['metrics'] = {entry['model']: {'mse_test': entry['mse_test'], 'r2_test': entry['r2_test'],
+                                                       'selected': True}}
+
+            if action == 'warm_start':
+                entry['drift'], metrics = warm_start_segment(group_df, hashes, previous, previous_hashes, property_type,
+                                                             region, models_dir, n_jobs, statistics)
+                if metrics is not None:
+                    summary['metrics'] = metrics
+                else:
+                    action = 'full_refit'
+                    reason = 'features changed' if 'features' in entry['drift'] else 'drift above the limits'
+
+            if action == 'full_refit':
+                X, y = prepare_segment(group_df, property_type, region, statistics)
+
+                X_train, X_test, y_train, y_test, scaler = split_data(X, y, return_scaler=True)
+
+                summary['metrics'] = train_models(X_train, X_test, y_train, y_test, property_type, region, models_dir, n_jobs)
+                entry['features'] = list(X.columns)
+                entry['scaler'] = {'mean': scaler.mean_.tolist(), 'scale': scaler.scale_.tolist()}
+
+            if action != 'skip':
+                # Record the state the next incremental training compares the segment with
+                model, metrics = next((name, metrics) for name, metrics in summary['metrics'].items() if metrics['selected'])
+                record_training(entry, hashes, model, metrics, models_dir, property_type, region)
+
+            entry.update(action=action, reason=reason)
+            summary['rows'] = len(hashes)
+            summary['manifest'] = entry
+    except Exception as e:
+        summary['error'] = f'{type(e).__name__}: {e}'
+
+    summary['seconds'] = time.perf_counter() - start
+    summary['log'] = log.getvalue()
+
+    return summary
+
+
+def train_partition(partitions_dir, property_type, region, models_dir, n_jobs, previous=None, incremental=False):
+    """
+    Runs the training pipeline for a single segment written to disk by src.streaming.
+
+    Only the partition of this segment is loaded, so the memory of each training process is bounded
+    by the size of its segment rather than the size of the whole dataset.
+
+    Parameters:
+    partitions_dir (str): The directory the partitions were written to.
+    property_type (str): The type of property ('house' or 'apartment').
+    region (str): The region of the property.
+    models_dir (str): The directory the trained models are saved to.
+    n_jobs (int): The number of threads used by XGBoost.
+    previous (dict): The manifest entry of the previous training of the segment, or None.
+    incremental (bool): Whether to skip or warm-start the segment when its previous training allows it.
+
+    Returns:
+    dict: The summary of the segment, as returned by train_segment.
+    """
+    group_df, statistics = load_partition(partitions_dir, property_type, region)
+
+    return train_segment(group_df, property_type, region, models_dir, n_jobs, statistics, previous, incremental)
+
+
+def load_manifest(models_dir):
+    """
+    Loads the training manifest of a models directory.
+
+    Parameters:
+    models_dir (str): The directory the models are saved to.
+
+    Returns:
+    dict: The manifest entry of every segment trained so far, keyed by '{property_type}_{region}'.
+    """
+    path = os.path.join(models_dir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)['segments']
+
+
+def save_manifest(models_dir, summaries):
+    """
+    Updates the training manifest with the segments of a training run.
+
+    For every segment, the manifest records what was done in the last run and why ('action' and 'reason'),
+    the drift metrics of the new rows when a warm start was considered, and the state the next incremental
+    run compares the segment with: the fingerprint and number of its rows, its features and scaler, and the
+    kind and test metrics of its model. Segments that failed keep their previous state, with the error.
+
+    Parameters:
+    models_dir (str): The directory the models are saved to.
+    summaries (list): The segment summaries of the run, as returned by train_segment.
+
+    Returns:
+    dict: The updated manifest entries.
+    """
+    segments = load_manifest(models_dir)
+
+    for summary in summaries:
+        key = f"{summary['property_type']}_{summary['region']}"
+        if 'error' in summary:
+            segments[key] = dict(segments.get(key, {}), action='failed', reason=summary['error'])
+        else:
+            segments[key] = summary['manifest']
+
+    path = os.path.join(models_dir, MANIFEST_FILENAME)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump({'segments': dict(sorted(segments.items()))}, f, indent=2)
+    os.replace(temporary_path, path)
+
+    return segments
+
+
+def train_all_segments(data_path, models_dir='./models', workers=None, partitions_dir=None, incremental=False):
+    """
+    Trains the models of every (property_type, region) segment in parallel.
+
+    Each segment is trained in its own process. The cores are shared between the processes, so XGBoost
+    gets cpu_count // workers threads per process and the pool never runs more threads than there are cores.
+
+    Parameters:
+    data_path (str): The path of the property data csv file.
+    models_dir (str): The directory the trained models are saved to.
+    workers (int): The number of processes. None uses one process per core.
+    partitions_dir (str): Optional directory of partitions written by src.streaming, used instead of data_path.
+    incremental (bool): Whether to skip the segments whose rows did not change since the last training and
+    warm-start the ones that only received new rows (see train_segment).
+
+    Returns:
+    list: The summary of every segment, as returned by train_segment, sorted by segment. The training
+    manifest of the models directory is updated with them.
+    """
+    cpu_count = os.cpu_count() or 1
+    workers = workers or cpu_count
+    n_jobs = max(1, cpu_count // workers)
+
+    os.makedirs(models_dir, exist_ok=True)
+    manifest = load_manifest(models_dir)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if partitions_dir is not None:
+            # Let every process load its own partition
+            futures = [
+                executor.submit(train_partition, partitions_dir, property_type, region, models_dir, n_jobs,
+                                manifest.get(f'{property_type}_{region}'), incremental)
+                for property_type, region in list_partitions(partitions_dir)
+            ]
+        else:
+            df = load_and_clean_data(data_path)
+            futures = [
+                executor.submit(train_segment, group_df, property_type, region, models_dir, n_jobs, None,
+                                manifest.get(f'{property_type}_{region}'), incremental)
+                for (property_type, region), group_df in df.groupby(['Type of property', 'Region'], observed=True)
+            ]
+        summaries = [future.result() for future in futures]
+
+    save_manifest(models_dir, summaries)
+
+    return sorted(summaries, key=lambda summary: (summary['property_type'], summary['region']))
+
+
+def print_summary(summaries, total_seconds):
+    """
+    Prints the wall-clock time, action and test metrics of every segment as a table.
+
+    Skipped segments show the metrics of their previous training, and warm-started segments only have
+    XGBoost metrics, computed on the held out new rows (or kept from the previous training when they are too few).
+
+    Parameters:
+    summaries (list): The segment summaries returned by train_all_segments.
+    total_seconds (float): The wall-clock time of the whole training run.
+
+    Returns:
+    None
+    """
+    print(f"{'Segment':<32} {'Rows':>6} {'Time (s)':>9} {'Action':>10} {'LR R^2':>8} {'XGB R^2':>8} "
+          f"{'MSE (test)':>12} {'Saved':>6}")
+
+    for summary in summaries:
+        segment = f"{summary['property_type']} / {summary['region']}"
+
+        if 'error' in summary:
+            print(f"{segment:<32} {'':>6} {summary['seconds']:>9.2f}  FAILED: {summary['error']}")
+            continue
+
+        metrics = summary['metrics']
+        r2 = {name: f"{metrics[name]['r2_test']:.2f}" if name in metrics else '' for name in ('linear_regression', 'xgboost')}
+        saved, selected = next((name, metrics) for name, metrics in metrics.items() if metrics['selected'])
+        action = {'full_refit': 'refit', 'warm_start': 'warm start', 'skip': 'skipped'}[summary['manifest']['action']]
+        print(f"{segment:<32} {summary['rows']:>6} {summary['seconds']:>9.2f} {action:>10} "
+              f"{r2['linear_regression']:>8} {r2['xgboost']:>8} {selected['mse_test']:>12.4g} "
+              f"{'LR' if saved == 'linear_regression' else 'XGB':>6}")
+
+    actions = [summary['manifest']['action'] for summary in summaries if 'error' not in summary]
+    print(f"Processed {len(summaries)} segments in {total_seconds:.2f} s: {actions.count('full_refit')} refitted, "
+          f"{actions.count('warm_start')} warm-started, {actions.count('skip')} skipped")
+
+
+def main(argv=None):
+    """
+    Command line entry point that trains the models of every segment: python -m src.train
+
+    Parameters:
+    argv (list): The command line arguments. None uses sys.argv.
+
+    Returns:
+    int: The exit code, 1 if any segment failed and 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(description='Train the price models of every (property type, region) segment.')
+    parser.add_argument('--data', default='./data/property_data.csv', help='path of the property data csv file')
+    parser.add_argument('--models-dir', default='./models', help='directory the trained models are saved to')
+    parser.add_argument('--partitions', default=None, help='directory of partitions written by src.streaming, used instead of --data')
+    parser.add_argument('--workers', type=int, default=None, help='number of training processes (default: one per core)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip the segments whose rows did not change and warm-start the ones that only received new rows')
+    parser.add_argument('--verbose', action='store_true', help='print the training log of every segment')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    summaries = train_all_segments(args.data, args.models_dir, args.workers, args.partitions, args.incremental)
+
+    if args.verbose:
+        for summary in summaries:
+            print(summary['log'], end='')
+
+    print_summary(summaries, time.perf_counter() - start)
+
+    return 1 if any('error' in summary for summary in summaries) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+import numpy as np
+
+from src import comparables
+from src.comparables import ComparablesIndex
+
+SEGMENT = ('apartment', 'Namur')
+
+
+def make_index(n_listings=200):
+    rng = np.random.default_rng(0)
+    features = rng.normal(100, 30, (n_listings, 5))
+    return ComparablesIndex({SEGMENT: (0, n_listings)}, [features.mean(axis=0)], [features.std(axis=0)], features,
+                            rng.uniform(1e5, 5e5, n_listings), np.full(n_listings, -1), [])
+
+
+def test_query_in_chunks_matches_query_in_one_pass(monkeypatch):
+    index = make_index()
+    X = np.random.default_rng(1).normal(100, 30, (50, 5))
+    rows, distances = index.query(*SEGMENT, X, k=5)
+
+    monkeypatch.setattr(comparables, 'QUERY_CHUNK_ROWS', 8)
+    chunked_rows, chunked_distances = index.query(*SEGMENT, X, k=5)
+
+    np.testing.assert_array_equal(chunked_rows, rows)
+    np.testing.assert_allclose(chunked_distances, distances)
+
+
+def test_query_returns_closest_listings_sorted_by_distance():
+    index = make_index()
+    X = index.features[[3, 42]]
+    rows, distances = index.query(*SEGMENT, X, k=4)
+
+    assert rows.shape == distances.shape == (2, 4)
+    assert rows[:, 0].tolist() == [3, 42]
+    np.testing.assert_allclose(distances[:, 0], 0, atol=1e-6)
+    assert np.all(np.diff(distances, axis=1) >= 0)
+
+
+def test_query_of_unknown_segment_returns_none():
+    assert make_index().query('house', 'Namur', np.zeros((1, 5))) is None
@@ -0,0 +1,74 @@
+import os
+import shutil
+
+from src.model_registry import ModelRegistry
+
+SEGMENT = ('apartment', 'Namur')
+
+
+def copy_model(models_dir, region='Namur', name='apartment_Namur_model.npz'):
+    path = os.path.join(models_dir, name)
+    shutil.copy(f'models/apartment_{region}_model.npz', path)
+    return path
+
+
+def test_refresh_reloads_file_replaced_with_preserved_mtime(tmp_path):
+    path = copy_model(tmp_path)
+    registry = ModelRegistry(models_dir=str(tmp_path))
+    events = []
+    registry.add_listener(lambda event, *segment_and_seconds: events.append(event))
+    old_model = registry.get(*SEGMENT)
+
+    # Rename another model over the file, with the modification time of the previous one
+    stat = os.stat(path)
+    new_path = copy_model(tmp_path, region='Liege', name='new_model.npz')
+    os.utime(new_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(new_path, path)
+    assert os.stat(path).st_mtime_ns == stat.st_mtime_ns
+
+    assert registry.refresh() == [SEGMENT]
+    assert registry.get(*SEGMENT) is not old_model
+    assert events == ['load', 'reload']
+    assert registry.refresh() == []
+
+
+def test_refresh_removes_evicted_model_whose_file_changed(tmp_path):
+    path = copy_model(tmp_path)
+    registry = ModelRegistry(models_dir=str(tmp_path))
+    events = []
+    registry.add_listener(lambda event, *segment_and_seconds: events.append(event))
+    registry.get(*SEGMENT)
+    registry.evict(*SEGMENT)
+
+    os.replace(copy_model(tmp_path, region='Liege', name='new_model.npz'), path)
+
+    assert registry.refresh() == [SEGMENT]
+    assert registry.get(*SEGMENT) is not None
+    assert events == ['load', 'evict', 'remove', 'load']
+
+
+def test_load_after_eviction_of_changed_file_is_a_reload(tmp_path):
+    path = copy_model(tmp_path)
+    registry = ModelRegistry(models_dir=str(tmp_path))
+    events = []
+    registry.add_listener(lambda event, *segment_and_seconds: events.append(event))
+    registry.get(*SEGMENT)
+    registry.evict(*SEGMENT)
+    registry.get(*SEGMENT)
+
+    os.replace(copy_model(tmp_path, region='Liege', name='new_model.npz'), path)
+    registry.evict(*SEGMENT)
+    registry.get(*SEGMENT)
+
+    assert events == ['load', 'evict', 'load', 'evict', 'reload']
+
+
+def test_refresh_removes_deleted_model(tmp_path):
+    path = copy_model(tmp_path)
+    registry = ModelRegistry(models_dir=str(tmp_path))
+    registry.get(*SEGMENT)
+
+    os.remove(path)
+
+    assert registry.refresh() == [SEGMENT]
+    assert registry.get(*SEGMENT) is None
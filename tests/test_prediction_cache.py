@@ -0,0 +1,70 @@
+import shutil
+
+import pytest
+
+from src.model_registry import ModelRegistry
+from src.prediction_cache import PredictionCache
+
+SEGMENT = ('apartment', 'Namur')
+FEATURES = [2, 90.0, 5.0, 0.0, 2]
+
+
+@pytest.mark.parametrize('event', ['load', 'evict'])
+def test_load_and_evict_keep_cached_predictions(event):
+    cache = PredictionCache()
+    generation = cache.generation(SEGMENT)
+    cache.put(SEGMENT, FEATURES, 1.0, generation)
+
+    cache.on_model_event(event, *SEGMENT, None)
+
+    assert cache.generation(SEGMENT) == generation
+    assert cache.get(SEGMENT, FEATURES) == 1.0
+
+
+@pytest.mark.parametrize('event', ['reload', 'remove'])
+def test_reload_and_remove_drop_cached_predictions(event):
+    cache = PredictionCache()
+    cache.put(SEGMENT, FEATURES, 1.0, cache.generation(SEGMENT))
+    other = ('house', 'Namur')
+    cache.put(other, FEATURES, 2.0, cache.generation(other))
+
+    cache.on_model_event(event, *SEGMENT, None)
+
+    assert cache.generation(SEGMENT) == 1
+    assert cache.get(SEGMENT, FEATURES) is None
+    assert cache.get(other, FEATURES) == 2.0
+
+
+def test_prediction_of_replaced_model_is_not_cached():
+    cache = PredictionCache()
+    generation = cache.generation(SEGMENT)
+
+    cache.on_model_event('reload', *SEGMENT, 0.1)
+    cache.put(SEGMENT, FEATURES, 1.0, generation)
+
+    assert cache.get(SEGMENT, FEATURES) is None
+    assert cache.stale_puts == 1
+
+
+def test_lazy_loading_under_lru_bound_keeps_cache_hits(tmp_path):
+    segments = [('apartment', 'Namur'), ('apartment', 'Liege'), ('apartment', 'Limburg')]
+    for property_type, region in segments:
+        shutil.copy(f'models/{property_type}_{region}_model.npz', tmp_path)
+
+    registry = ModelRegistry(models_dir=str(tmp_path), max_size=2)
+    cache = PredictionCache(max_size=100)
+    registry.add_listener(cache.on_model_event)
+
+    # Rotating over more segments than the registry holds evicts a model on every load
+    for _ in range(3):
+        for segment in segments:
+            if cache.get(segment, FEATURES) is not None:
+                continue
+
+            generation = cache.generation(segment)
+            model = registry.get(*segment)
+            cache.put(segment, FEATURES, float(model.predict([FEATURES])[0]), generation)
+
+    assert cache.stale_puts == 0
+    assert cache.misses == len(segments)
+    assert cache.hits == 2 * len(segments)
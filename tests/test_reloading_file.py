@@ -0,0 +1,68 @@
+import os
+
+from src.reloading_file import ReloadingFile
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_loads_file_again_when_it_changes(tmp_path):
+    path = str(tmp_path / 'data.txt')
+    write(path, 'first')
+    reloading_file = ReloadingFile(path, read, check_interval=0)
+
+    assert reloading_file.get() == 'first'
+
+    write(path, 'second')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    assert reloading_file.get() == 'second'
+
+
+def test_loads_file_renamed_over_it_with_preserved_mtime(tmp_path):
+    path = str(tmp_path / 'data.txt')
+    write(path, 'first')
+    reloading_file = ReloadingFile(path, read, check_interval=0)
+    assert reloading_file.get() == 'first'
+
+    stat = os.stat(path)
+    new_path = str(tmp_path / 'data.txt.tmp')
+    write(new_path, 'second')
+    os.utime(new_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(new_path, path)
+
+    assert reloading_file.get() == 'second'
+
+
+def test_does_not_check_file_within_check_interval(tmp_path):
+    path = str(tmp_path / 'data.txt')
+    write(path, 'first')
+    reloading_file = ReloadingFile(path, read, check_interval=3600)
+    assert reloading_file.get() == 'first'
+
+    new_path = str(tmp_path / 'data.txt.tmp')
+    write(new_path, 'second')
+    os.replace(new_path, path)
+
+    assert reloading_file.get() == 'first'
+
+
+def test_returns_none_when_file_is_missing(tmp_path):
+    path = str(tmp_path / 'data.txt')
+    reloading_file = ReloadingFile(path, read, check_interval=0)
+
+    assert reloading_file.get() is None
+
+    write(path, 'first')
+    assert reloading_file.get() == 'first'
+
+    os.remove(path)
+    assert reloading_file.get() is None